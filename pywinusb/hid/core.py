@@ -8,8 +8,10 @@ are available in the top level hid package
 from __future__ import absolute_import
 from __future__ import print_function
 
+import re
 import sys
 import ctypes
+import time
 import threading
 import collections
 if sys.version_info >= (3,):
@@ -64,6 +66,45 @@ def get_short_usage_id(full_usage_id):
     """Extract 16 bits usage id from full usage id (32 bits)"""
     return full_usage_id & 0xffff
 
+def c_ubyte_buffer(data):
+    """Return a c_ubyte array sharing memory with data (c_ubyte arrays,
+    bytearray, writable memoryview or any other writable buffer), None if
+    data is not a writable contiguous buffer
+    """
+    if isinstance(data, ctypes.Array) and issubclass(data._type_, c_ubyte):
+        return data
+    try:
+        view = memoryview(data)
+        if view.readonly:
+            return None
+        view = view.cast('B')
+        return (c_ubyte * view.nbytes).from_buffer(view)
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+def copy_raw_data(target, data):
+    """Copy data (any buffer object or sequence of integers) into the
+    c_ubyte array target, in one block when data is a buffer
+    """
+    try:
+        view = memoryview(data).cast('B')
+        memoryview(target).cast('B')[:view.nbytes] = view
+    except (TypeError, ValueError, AttributeError):
+        for index in range( len(data) ):
+            target[index] = data[index]
+
+# USB HID device paths look like \\?\hid#vid_231d&pid_0200&col01#...
+_PATH_IDS = re.compile(r"vid_([0-9a-f]{4})&pid_([0-9a-f]{4})", re.IGNORECASE)
+
+def get_path_ids(device_path):
+    """Vendor and product id as found in the device path, (None, None)
+    if the path does not have them (i.e. non USB HID devices)
+    """
+    match = _PATH_IDS.search(device_path)
+    if not match:
+        return None, None
+    return int(match.group(1), 16), int(match.group(2), 16)
+
 def hid_device_path_exists(device_path, guid = None):
     """Test if required device_path is still valid
     (HID device connected to host)
@@ -85,8 +126,19 @@ def hid_device_path_exists(device_path, guid = None):
     # Not any device now with that path
     return False
 
-def find_all_hid_devices():
-    "Finds all HID devices connected to the system"
+def find_all_hid_devices(vendor_id = None, product_id = None,
+        max_workers = None, timeout = None):
+    """Finds all HID devices connected to the system, optionally only the
+    ones matching vendor_id and/or product_id. Devices are rejected on
+    the ids in their path before being opened, devices without ids in the
+    path are opened and left for the caller to check.
+
+    Interface paths are collected first, then each device is opened to
+    read its attributes. With max_workers these probes run concurrently
+    on up to max_workers threads, a device whose probe takes longer than
+    timeout seconds is left out (see probe_hid_devices). Results are in
+    enumeration order either way
+    """
     #
     # From DDK documentation (finding and Opening HID collection):
     # After a user-mode application is loaded, it does the following sequence
@@ -114,7 +166,7 @@ def find_all_hid_devices():
     guid = winapi.GetHidGuid()
 
     # retrieve all the available interface information.
-    results = []
+    candidates = []
     required_size = DWORD()
 
     info_data         = winapi.SP_DEVINFO_DATA()
@@ -126,6 +178,13 @@ def find_all_hid_devices():
                     interface_data,
                     byref(info_data))
 
+            if vendor_id is not None or product_id is not None:
+                path_vendor_id, path_product_id = get_path_ids(device_path)
+                if path_vendor_id is not None and (
+                        vendor_id not in (None, path_vendor_id) or
+                        product_id not in (None, path_product_id)):
+                    continue
+
             parent_device = c_ulong()
 
             #get parent instance id (so we can discriminate on port)
@@ -145,15 +204,72 @@ def find_all_hid_devices():
                         device_instance_id, required_size,
                         byref(required_size) )
 
-                hid_device = HidDevice(device_path,
-                        parent_device.value, device_instance_id.value )
+                candidates.append( (device_path,
+                        parent_device.value, device_instance_id.value) )
             else:
-                hid_device = HidDevice(device_path, parent_device.value )
+                candidates.append( (device_path, parent_device.value) )
+
+    # add devices to results, if not protected
+    return [hid_device for hid_device in probe_hid_devices(candidates,
+                max_workers, timeout)
+            if hid_device is not None and hid_device.vendor_id]
+
+def probe_hid_devices(candidates, max_workers = None, timeout = None):
+    """Create HidDevice objects from a list of HidDevice argument tuples,
+    in the same order. Serially when max_workers is not given, otherwise
+    on up to max_workers threads at a time. A device not done timeout
+    seconds after its probe started is returned as None; its thread is
+    left to finish in the background and no longer counts towards
+    max_workers, so hung devices do not hold up the rest
+    """
+    if not max_workers or max_workers < 2 or len(candidates) < 2:
+        return [HidDevice(*args) for args in candidates]
 
-            # add device to results, if not protected
-            if hid_device.vendor_id:
-                results.append(hid_device)
-    return results
+    results = [None] * len(candidates)
+    finished = set()
+    condition = threading.Condition()
+
+    def probe(index, args):
+        "Probe thread"
+        try:
+            hid_device = HidDevice(*args)
+        except Exception:
+            hid_device = None
+        with condition:
+            results[index] = hid_device
+            finished.add(index)
+            condition.notify()
+
+    pending = collections.deque(enumerate(candidates))
+    running = dict() # index -> probe start time
+    accepted = set()
+    with condition:
+        while pending or running:
+            # start probes up to the limit
+            while pending and len(running) < max_workers:
+                index, args = pending.popleft()
+                running[index] = time.time()
+                thread = threading.Thread(target = probe, args = (index, args))
+                thread.daemon = True
+                thread.start()
+            # collect finished and give up on overdue probes
+            now = time.time()
+            deadline = None
+            for index, started in list(running.items()):
+                if index in finished:
+                    accepted.add(index)
+                    del running[index]
+                elif timeout is not None:
+                    if now - started >= timeout:
+                        del running[index]
+                    elif deadline is None or started + timeout < deadline:
+                        deadline = started + timeout
+            if not running or (pending and len(running) < max_workers):
+                continue
+            condition.wait(None if deadline is None else deadline - now)
+        # late probes may still store results, only keep the accepted ones
+        return [results[index] if index in accepted else None
+                for index in range(len(candidates))]
 
 class HidDeviceFilter(object):
     """This class allows searching for HID devices currently connected to
@@ -181,14 +297,27 @@ class HidDeviceFilter(object):
                 dev_group[parent_id] = device_set
         return dev_group
 
-    def get_devices(self, hid_filter = None):
+    def get_path_filter_params(self):
+        """Filter parameters that can be checked on the device path,
+        the vendor and product ids when not masked
+        """
+        return dict((item, self.filter_params[item])
+                for item in ("vendor_id", "product_id")
+                if item in self.filter_params and
+                    item + "_mask" not in self.filter_params)
+
+    def get_devices(self, hid_filter = None, max_workers = None,
+            timeout = None):
         """Filter a HID device list by current object parameters. Devices
-        must match the all of the filtering parameters
+        must match the all of the filtering parameters. When devices are
+        queried max_workers and timeout are passed to find_all_hid_devices
         """
         if not hid_filter: #empty list or called without any parameters
             if type(hid_filter) == type(None):
-                #request to query connected devices
-                hid_filter = find_all_hid_devices()
+                #request to query connected devices, plain vendor and
+                #product ids are already applied while enumerating
+                hid_filter = find_all_hid_devices(max_workers = max_workers,
+                        timeout = timeout, **self.get_path_filter_params())
             else:
                 return hid_filter
         #initially all accepted
@@ -287,6 +416,9 @@ class HidDevice(HidDeviceBaseClass):
         #initialize hardware related vars
         self.__button_caps_storage     = list()
         self.report_set                = dict()
+        self.__reports_cache           = dict()
+        self.__send_buffers            = dict()
+        self.__send_lock               = threading.Lock()
         self.__evt_handlers            = dict()
         self.__reading_thread          = None
         self.__input_processing_thread = None
@@ -300,24 +432,15 @@ class HidDevice(HidDeviceBaseClass):
         self.device_path        = device_path
         self.instance_id        = instance_id
         self.parent_instance_id = parent_instance_id
-        self.product_name       = ""
-        self.vendor_name        = ""
-        self.serial_number      = ""
         self.vendor_id          = 0
         self.product_id         = 0
         self.version_number     = 0
         HidDeviceBaseClass.__init__(self)
 
-        # HID device handle first
-        h_hid = INVALID_HANDLE_VALUE
-        try:
-            h_hid = int( winapi.CreateFile(device_path,
-                winapi.GENERIC_READ | winapi.GENERIC_WRITE,
-                winapi.FILE_SHARE_READ | winapi.FILE_SHARE_WRITE,
-                None, winapi.OPEN_EXISTING, 0, 0))
-        except:
-            pass
-
+        # HID device handle first, only the attributes are read here, the
+        # strings (vendor_name, product_name, serial_number) are read when
+        # first used or on hydrate()
+        h_hid = self.__open_query_handle()
         if h_hid == INVALID_HANDLE_VALUE:
             return
 
@@ -334,67 +457,130 @@ class HidDevice(HidDeviceBaseClass):
             self.product_id = hidd_attributes.product_id
             self.version_number = hidd_attributes.version_number
             del hidd_attributes
-
-            # manufacturer string
-            vendor_string_type = c_wchar * self.MAX_MANUFACTURER_STRING_LEN
-            vendor_name = vendor_string_type()
-            if not hid_dll.HidD_GetManufacturerString(h_hid,
-                    byref(vendor_name),
-                    sizeof(vendor_name)) or not len(vendor_name.value):
-                # would be any possibility to get a vendor id table?,
-                # maybe not worth it
-                self.vendor_name = "Unknown manufacturer"
-            else:
-                self.vendor_name = vendor_name.value
-            del vendor_name
-            del vendor_string_type
-
-            # string buffer for product string
-            product_name_type = c_wchar * self.MAX_PRODUCT_STRING_LEN
-            product_name = product_name_type()
-            if not hid_dll.HidD_GetProductString(h_hid,
-                        byref(product_name),
-                        sizeof(product_name)) or not len(product_name.value):
-                # alternate method, refer to windows registry for product
-                # information
-                path_parts = device_path[len("\\\\.\\"):].split("#")
-                h_register = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE,
-                    "SYSTEM\\CurrentControlSet\\Enum\\" + \
-                    path_parts[0] + "\\" + \
-                    path_parts[1] + "\\" + \
-                    path_parts[2] )
-                self.product_name, other = winreg.QueryValueEx(h_register,
-                        "DeviceDesc")
-                winreg.CloseKey(h_register)
-            else:
-                self.product_name = product_name.value
-            del product_name
-            del product_name_type
-
-            # serial number string
-            serial_number_string = c_wchar * self.MAX_SERIAL_NUMBER_LEN
-            serial_number = serial_number_string()
-            if not hid_dll.HidD_GetSerialNumberString(h_hid,
-                    byref(serial_number),
-                    sizeof(serial_number)) or not len(serial_number.value):
-                self.serial_number = ""
-            else:
-                self.serial_number = serial_number.value
-            del serial_number
-            del serial_number_string
         finally:
             # clean up
             winapi.CloseHandle(h_hid)
 
+    def __open_query_handle(self):
+        """Handle to query device attributes and strings,
+        INVALID_HANDLE_VALUE if the device can't be opened
+        """
+        try:
+            return int( winapi.CreateFile(self.device_path,
+                winapi.GENERIC_READ | winapi.GENERIC_WRITE,
+                winapi.FILE_SHARE_READ | winapi.FILE_SHARE_WRITE,
+                None, winapi.OPEN_EXISTING, 0, 0))
+        except:
+            return INVALID_HANDLE_VALUE
+
+    string_attributes = ("vendor_name", "product_name", "serial_number")
+
+    @helpers.lazy_attribute
+    def vendor_name(self):
+        """Manufacturer string, read from the device on first access"""
+        return self.hydrate().vendor_name
+
+    @helpers.lazy_attribute
+    def product_name(self):
+        """Product string, read from the device on first access"""
+        return self.hydrate().product_name
+
+    @helpers.lazy_attribute
+    def serial_number(self):
+        """Serial number string, read from the device on first access"""
+        return self.hydrate().serial_number
+
+    def hydrate(self):
+        """Read the string attributes not read yet, all of them using a
+        single device handle, returns self
+        """
+        missing = [name for name in self.string_attributes
+                if name not in self.__dict__]
+        if not missing:
+            return self
+        strings = dict.fromkeys(self.string_attributes, "")
+        h_hid = INVALID_HANDLE_VALUE
+        if self.vendor_id:
+            h_hid = self.__open_query_handle()
+        if h_hid != INVALID_HANDLE_VALUE:
+            try:
+                strings = self.__read_strings(h_hid)
+            finally:
+                winapi.CloseHandle(h_hid)
+        for name in missing:
+            self.__dict__[name] = strings[name]
+        return self
+
+    def __read_strings(self, h_hid):
+        """Read manufacturer, product and serial number strings"""
+        strings = dict()
+
+        # manufacturer string
+        vendor_string_type = c_wchar * self.MAX_MANUFACTURER_STRING_LEN
+        vendor_name = vendor_string_type()
+        if not hid_dll.HidD_GetManufacturerString(h_hid,
+                byref(vendor_name),
+                sizeof(vendor_name)) or not len(vendor_name.value):
+            # would be any possibility to get a vendor id table?,
+            # maybe not worth it
+            strings["vendor_name"] = "Unknown manufacturer"
+        else:
+            strings["vendor_name"] = vendor_name.value
+        del vendor_name
+        del vendor_string_type
+
+        # string buffer for product string
+        product_name_type = c_wchar * self.MAX_PRODUCT_STRING_LEN
+        product_name = product_name_type()
+        if not hid_dll.HidD_GetProductString(h_hid,
+                    byref(product_name),
+                    sizeof(product_name)) or not len(product_name.value):
+            # alternate method, refer to windows registry for product
+            # information
+            path_parts = self.device_path[len("\\\\.\\"):].split("#")
+            h_register = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE,
+                "SYSTEM\\CurrentControlSet\\Enum\\" + \
+                path_parts[0] + "\\" + \
+                path_parts[1] + "\\" + \
+                path_parts[2] )
+            strings["product_name"], other = winreg.QueryValueEx(h_register,
+                    "DeviceDesc")
+            winreg.CloseKey(h_register)
+        else:
+            strings["product_name"] = product_name.value
+        del product_name
+        del product_name_type
+
+        # serial number string
+        serial_number_string = c_wchar * self.MAX_SERIAL_NUMBER_LEN
+        serial_number = serial_number_string()
+        if not hid_dll.HidD_GetSerialNumberString(h_hid,
+                byref(serial_number),
+                sizeof(serial_number)) or not len(serial_number.value):
+            strings["serial_number"] = ""
+        else:
+            strings["serial_number"] = serial_number.value
+        del serial_number
+        del serial_number_string
+        return strings
+
     def is_active(self):
         """Poll if device is still valid"""
         if not self.vendor_id:
             return False
         return True
 
-    def open(self, output_only = False, shared = True):
+    def open(self, output_only = False, shared = True, feature_only = False,
+            raw_only = False):
         """Open HID device and obtain 'Collection Information'.
         It effectively prepares the HidDevice object for reading and writing
+
+        Lightweight modes for write-only use, both imply output_only:
+            feature_only    only feature report capabilities are parsed, so
+                            only find_feature_reports() gives results
+            raw_only        no report capabilities are parsed, raw reports
+                            can be sent with send_feature_report() and
+                            send_output_report()
         """
         if self.is_opened():
             raise HIDError("Device already opened")
@@ -457,6 +643,13 @@ class HidDevice(HidDeviceBaseClass):
             ),
         ]
 
+        if raw_only:
+            all_items = []
+        elif feature_only:
+            all_items = [item for item in all_items if item[0] == HidP_Feature]
+        if raw_only or feature_only:
+            output_only = True
+
         for report_kind, struct_kind, max_items, get_control_caps in all_items:
             if not int(max_items):
                 continue #nothing here
@@ -517,20 +710,37 @@ class HidDevice(HidDeviceBaseClass):
             return [x for x in raw_data]
         return []
 
+    def __raw_send_buffer(self, data):
+        """c_ubyte storage for data to be sent. Writable buffers (c_ubyte
+        arrays, bytearray, memoryview) are used in place, anything else is
+        copied into a per length buffer reused by later sends. Call with
+        __send_lock held"""
+        raw_data = c_ubyte_buffer(data)
+        if raw_data is None:
+            try:
+                length = memoryview(data).nbytes
+            except TypeError:
+                length = len(data)
+            raw_data = self.__send_buffers.get(length)
+            if raw_data is None:
+                raw_data = (c_ubyte * length)()
+                self.__send_buffers[length] = raw_data
+            copy_raw_data(raw_data, data)
+        return raw_data
+
     def send_output_report(self, data):
-        """Send input/output/feature report ID = report_id, data should be a
-        c_ubyte object with included the required report data
+        """Send input/output/feature report ID = report_id, data can be a
+        c_ubyte array, any other buffer object (bytes, bytearray,
+        memoryview) or a sequence of integers, with included the required
+        report data
         """
         assert( self.is_opened() )
-        #make sure we have c_ubyte array storage
-        if not ( isinstance(data, ctypes.Array) and \
-                issubclass(data._type_, c_ubyte) ):
-            raw_data_type = c_ubyte * len(data)
-            raw_data = raw_data_type()
-            for index in range( len(data) ):
-                raw_data[index] = data[index]
-        else:
-            raw_data = data
+        with self.__send_lock:
+            return self.__send_output_report(
+                self.__raw_send_buffer(data))
+
+    def __send_output_report(self, raw_data):
+        "Send output report from c_ubyte storage"
         #
         # Adding a lock when writing (overlapped writes)
         over_write = winapi.OVERLAPPED()
@@ -567,28 +777,23 @@ class HidDevice(HidDeviceBaseClass):
         return True #completed
 
     def send_feature_report(self, data):
-        """Send input/output/feature report ID = report_id, data should be a
-        c_byte object with included the required report data
+        """Send input/output/feature report ID = report_id, data can be a
+        c_ubyte array, any other buffer object (bytes, bytearray,
+        memoryview) or a sequence of integers, with included the required
+        report data. Writable buffers are sent without copying
         """
         assert( self.is_opened() )
-        #make sure we have c_ubyte array storage
-        if not ( isinstance(data, ctypes.Array) and issubclass(data._type_,
-                c_ubyte) ):
-            raw_data_type = c_ubyte * len(data)
-            raw_data = raw_data_type()
-            for index in range( len(data) ):
-                raw_data[index] = data[index]
-        else:
-            raw_data = data
-
-        return hid_dll.HidD_SetFeature(int(self.hid_handle), byref(raw_data),
-                len(raw_data))
+        with self.__send_lock:
+            raw_data = self.__raw_send_buffer(data)
+            return hid_dll.HidD_SetFeature(int(self.hid_handle),
+                    byref(raw_data), len(raw_data))
 
     def __reset_vars(self):
         """Reset vars (for init or gc)"""
         self.__button_caps_storage = list()
         self.usages_storage = dict()
         self.report_set = dict()
+        self.__reports_cache = dict()
         self.ptr_preparsed_data = None
         self.hid_handle = None
 
@@ -653,6 +858,22 @@ class HidDevice(HidDeviceBaseClass):
             item = button_caps_storage.pop()
             del item
 
+    def __get_report(self, report_type, report_id):
+        """Report object for report_type and report_id, None if the device
+        has no such report. Report objects are built once per open and
+        reused on later calls"""
+        if not self.is_opened():
+            raise HIDError("Device must be opened")
+        key = (report_type, report_id)
+        report_obj = self.__reports_cache.get(key)
+        if report_obj is None:
+            if report_id not in self.report_set.get(report_type, ()):
+                return None
+            #build report object, gathering usages matching report_id
+            report_obj = HidReport(self, report_type, report_id)
+            self.__reports_cache[key] = report_obj
+        return report_obj
+
     def __find_reports(self, report_type, usage_page, usage_id = 0):
         "Find input report referencing HID usage control/data item"
         if not self.is_opened():
@@ -661,17 +882,23 @@ class HidDevice(HidDeviceBaseClass):
         results = list()
         if usage_page:
             for report_id in self.report_set.get( report_type, set() ):
-                #build report object, gathering usages matching report_id
-                report_obj = HidReport(self, report_type, report_id)
+                report_obj = self.__get_report(report_type, report_id)
                 if get_full_usage_id(usage_page, usage_id) in report_obj:
                     results.append( report_obj )
         else:
             #all (any one)
             for report_id in self.report_set.get(report_type, set()):
-                report_obj = HidReport(self, report_type, report_id)
-                results.append( report_obj )
+                results.append( self.__get_report(report_type, report_id) )
         return results
 
+    def get_output_report(self, report_id):
+        "Output report object by report id, None if not available"
+        return self.__get_report(HidP_Output, report_id)
+
+    def get_feature_report(self, report_id):
+        "Feature report object by report id, None if not available"
+        return self.__get_report(HidP_Feature, report_id)
+
     def count_all_feature_reports(self):
         """Retreive total number of available feature reports"""
         return self.hid_caps.number_feature_button_caps + \
@@ -1312,8 +1539,7 @@ class HidReport(object):
             #initialize
             ctypes.memset(self.__raw_data, 0, len(self.__raw_data))
         if initial_values:
-            for index in range(len(initial_values)):
-                self.__raw_data[index] = initial_values[index]
+            copy_raw_data(self.__raw_data, initial_values)
 
     def set_raw_data(self, raw_data):
         """Set usage values based on given raw data, item[0] is report_id,
@@ -1485,12 +1711,8 @@ class HidReport(object):
         if not raw_data:
             # we'll construct the raw report
             self.__prepare_raw_data()
-        elif not ( isinstance(raw_data, ctypes.Array) and \
-                issubclass(raw_data._type_, c_ubyte) ):
-            # pre-memory allocation for performance
-            self.__alloc_raw_data(raw_data)
-        #reference proper object
-        raw_data = self.__raw_data
+            raw_data = self.__raw_data
+        # else the HID object takes any buffer (zero copy if writable)
         if self.__report_kind == HidP_Output:
             return self.__hid_object.send_output_report(raw_data)
         elif self.__report_kind == HidP_Feature:
@@ -70,6 +70,22 @@ def synchronized(lock):
         return new_function
     return wrap
 
+class lazy_attribute(object):
+    """Decorator for attributes computed on first access. The computed
+    value is stored as a plain instance attribute of the same name, so it
+    is computed once and shows in vars(). It can be assigned as usual.
+    """
+    def __init__(self, function):
+        self.function = function
+        self.__name__ = function.__name__
+        self.__doc__  = function.__doc__
+    def __get__(self, instance, owner = None):
+        if instance is None:
+            return self
+        value = self.function(instance)
+        instance.__dict__[self.__name__] = value
+        return value
+
 class ReadOnlyList(UserList):
     "Read only sequence wrapper"
     def __init__(self, any_list):
@@ -11,6 +11,8 @@ def write_documentation(self, output_file):
     "Issue documentation report on output_file file like object"
     if not self.is_opened():
         raise helpers.HIDError("Device has to be opened to get documentation")
+    # the string attributes are read on demand, vars() below needs them read
+    self.hydrate()
     #format
     class CompundVarDict(object):
         """Compound variables dictionary.
@@ -0,0 +1,70 @@
+# The table driven LED report checksum against the original bit by bit one (from pyvkb)
+
+import os
+import sys
+import random
+import struct
+
+# The sqlite3 folder next to the plugin is for Joystick Gremlin's Python and would shadow the standard
+# library one, so that is imported first with the plugin folder (and the current one) off the path.
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:] = [_ for _ in sys.path if os.path.abspath(_ or os.curdir) != PLUGIN_DIR]
+import sqlite3
+sys.path.append(PLUGIN_DIR)
+
+from vkb_led_jg_plugin_db_lib import (LED_REPORT_LEN, LED_MAX_CONFIG_COUNT, LEDChecksumClass,
+                                      _LED_conf_checksum, checksumLEDReports)
+
+
+def bitLoopChecksum(num_configs, buf):
+
+    def conf_checksum_bit(chk, b):
+        chk ^= b
+        for i in range(8):
+            _ = chk & 1
+            chk >>= 1
+            if _ != 0:
+                chk ^= 0xA001
+        return chk
+
+    chk = 0xFFFF
+    for i in range((num_configs + 1) * 3):
+        chk = conf_checksum_bit(chk, buf[i])
+    return struct.pack("<H", chk)
+
+# random reports of 1 to 30 configs, checksum bytes left at zero
+def randomReports(count, seed):
+    rng = random.Random(seed)
+    reports = []
+    for i in range(count):
+        num_configs = rng.randint(1, LED_MAX_CONFIG_COUNT)
+        report = bytearray(rng.getrandbits(8) for _ in range(LED_REPORT_LEN))
+        report[0:3] = bytes.fromhex("59a50a")
+        report[3:5] = bytes(2)
+        report[7] = num_configs
+        reports.append(bytes(report))
+    return reports
+
+
+def test_conf_checksum():
+    for report in randomReports(500, 1):
+        assert _LED_conf_checksum(report[7], report[5:]) == bitLoopChecksum(report[7], report[5:])
+
+def test_checksum_class_incremental():
+    for report in randomReports(200, 2):
+        data = report[5:5 + (report[7] + 1) * 3]
+        split = len(data) // 3
+        prefix = LEDChecksumClass().update(data[:split])
+        assert prefix.copy().update(data[split:]).digest() == bitLoopChecksum(report[7], report[5:])
+        # copy() leaves the prefix untouched
+        assert prefix.update(data[split:]).digest() == bitLoopChecksum(report[7], report[5:])
+
+def test_checksum_reports():
+    reports = randomReports(500, 3)
+    assert checksumLEDReports(reports) == [bitLoopChecksum(report[7], report[5:]) for report in reports]
+    assert checksumLEDReports([memoryview(report) for report in reports[:10]]) == \
+        [bitLoopChecksum(report[7], report[5:]) for report in reports[:10]]
+
+def test_empty_checksum():
+    assert LEDChecksumClass().digest() == struct.pack("<H", 0xFFFF)
+    assert checksumLEDReports([]) == []
@@ -133,7 +133,6 @@ else:
     # packup the UI inputs into the controlState variable
 
     LED_id = LEDNameToId(LEDName.value)
-    controlState.LEDConfig = LEDClass(LED_id = LED_id)
     if changesMode.value:
         controlState.whilePressed = False
     else:
@@ -143,36 +142,47 @@ else:
     controlState.dbName = DB_NAME
          
     # color1 & color2 have different uses depending on the LED id
+    LEDMode = 0
+    colorMode = 0
+    color1 = [0, 0, 0]
+    color2 = [0, 0, 0]
     if LED_id == 0:        # Base
         
-        controlState.LEDConfig.LEDMode = baseBlinkMode.value 
+        LEDMode = baseBlinkMode.value 
         if baseBlinkMode.value == 1 and (baseColorMode.value == 3 or baseColorMode.value == 4):
-            controlState.LEDConfig.colorMode = 4
+            colorMode = 4
         else:
-            controlState.LEDConfig.colorMode = baseColorMode.value - 1
+            colorMode = baseColorMode.value - 1
             
-        if controlState.LEDConfig.colorMode == 0:
-            controlState.LEDConfig.color1 = [baseBlueBrightness.value, 0, 0]
-            controlState.LEDConfig.color2 = [0, 0, 0]
-        elif controlState.LEDConfig.colorMode == 1:
-            controlState.LEDConfig.color1 = [baseRedBrightness.value, 0, 0]
-            controlState.LEDConfig.color2 = [0, 0, 0]
-        elif controlState.LEDConfig.colorMode > 1:
-            controlState.LEDConfig.color1 = [baseBlueBrightness.value, 0, 0]
-            controlState.LEDConfig.color2 = [baseRedBrightness.value, 0, 0]
+        if colorMode == 0:
+            color1 = [baseBlueBrightness.value, 0, 0]
+            color2 = [0, 0, 0]
+        elif colorMode == 1:
+            color1 = [baseRedBrightness.value, 0, 0]
+            color2 = [0, 0, 0]
+        elif colorMode > 1:
+            color1 = [baseBlueBrightness.value, 0, 0]
+            color2 = [baseRedBrightness.value, 0, 0]
     
     elif LED_id == 11:     # Hat    
-        controlState.LEDConfig.LEDMode = hatBlinkMode.value
-        controlState.LEDConfig.colorMode = 0 
-        controlState.LEDConfig.color1 = [hatRedBrightness.value, 0, 0]
-        controlState.LEDConfig.color2 = [0, 0, 0]
+        LEDMode = hatBlinkMode.value
+        colorMode = 0 
+        color1 = [hatRedBrightness.value, 0, 0]
+        color2 = [0, 0, 0]
     
     elif LED_id == 10:     # RGB
         
-        controlState.LEDConfig.LEDMode = rgbBlinkMode.value
-        controlState.LEDConfig.colorMode = rgbColorMode.value - 1
-        controlState.LEDConfig.color1 = stringRGBToList(rgbStrColor1.value)
-        controlState.LEDConfig.color2 = stringRGBToList(rgbStrColor2.value)    
+        LEDMode = rgbBlinkMode.value
+        colorMode = rgbColorMode.value - 1
+        color1 = stringRGBToList(rgbStrColor1.value)
+        color2 = stringRGBToList(rgbStrColor2.value)    
+
+    # LEDClass is immutable, so it is built once all the settings are known
+    controlState.LEDConfig = LEDClass(LED_id = LED_id,
+                                      colorMode = colorMode,
+                                      LEDMode = LEDMode,
+                                      color1 = color1,
+                                      color2 = color2)
     
     # set up the led configuration to go back to
     if LED_id == 10:
@@ -188,9 +198,15 @@ else:
                                                  color1 = (0,0,0),
                                                  color2 = (0,0,0))
    
-    ### open a db file.  This will be called for each instance but there is only one file
-    ### create an empty LEDStack table
-    createLEDStack(controlState.dbName)
+    ### start an empty LED event stack.  This will be called for each instance but only the first one
+    ### of a profile activation creates the stack, the others attach to it.
+    ### the instance is identified by its settings; it loads once per activation, so loading again
+    ### means the profile was started again.
+    ### the stack is kept in memory and mirrored to the db file by a background writer
+    instance = (str(getattr(buttonTrigger, "device_guid", "")), buttonTrigger.input_id, mode.value,
+                LED_id, changesMode.value, modeTo.value, controlState.whilePressed, bytes(controlState.LEDConfig))
+    createLEDStack(controlState.dbName, persist = True, writeBehind = True,
+                   session = getLEDStackSession(instance))
 
     
     decorator_button = buttonTrigger.create_decorator(mode.value)
@@ -200,27 +216,12 @@ else:
         global controlState
 
         button_id = "-".join([str(event.device_guid)[1:-1], str(event.identifier)])
-    
-        ### if the button is on the stack then it is in the "on" state
-        rowidCurrentBtn = getRowidButtonLEDModeEvent(controlState.dbName, button_id, controlState.LEDConfig.LED_id, controlState.mode)
-        buttonStateOn = rowidCurrentBtn > 0
-           
-        if not buttonStateOn and event.is_pressed:
-
-            pushButtonLEDEvent(controlState.dbName, button_id, controlState.LEDConfig, controlState.mode)
-            set_LEDs(controlState.vkbDevice, [controlState.LEDConfig])
-    
-        elif ((buttonStateOn and     event.is_pressed and not controlState.whilePressed) or      # normal button turn off
-              (buttonStateOn and not event.is_pressed and     controlState.whilePressed)):       # while pressed turn off
-
-            rowidLastLED = getLastRowidLEDEvent(controlState.dbName, controlState.LEDConfig.LED_id)
-            deleteRowid(controlState.dbName, rowidCurrentBtn)
-            if rowidCurrentBtn == rowidLastLED:
-                resultLED = pullLastLEDConfig(controlState.dbName, controlState.LEDConfig.LED_id)
-                if resultLED == None:
-                    set_LEDs(controlState.vkbDevice, [controlState.defaultLEDConfig])
-                else:
-                    set_LEDs(controlState.vkbDevice, [resultLED])
+
+        ### turn the button on or off in one step; resultLED is what the LED shows now, if it changed
+        resultLED = toggleButtonLEDEvent(controlState.dbName, button_id, controlState.LEDConfig, controlState.mode,
+                                         event.is_pressed, controlState.whilePressed, controlState.defaultLEDConfig)
+        if resultLED is not None:
+            queueLEDs(controlState.vkbDevice, [resultLED])
             
     
     # this function is called only in the MoveTo mode and removes the prior mode if on.
@@ -233,26 +234,10 @@ else:
             global controlState
     
             button_id = "-".join([str(event.device_guid)[1:-1], str(event.identifier)])
-        
-            ### if the button is on the stack then it is in the on state
-            rowidCurrentBtn = getRowidButtonLEDModeEvent(controlState.dbName, button_id, controlState.LEDConfig.LED_id)
-            buttonStateOn = rowidCurrentBtn > 0
-
-            if buttonStateOn and event.is_pressed:
-                
-                rowidLastLED = getLastRowidLEDEvent(controlState.dbName, controlState.LEDConfig.LED_id)
-                deleteRowid(controlState.dbName, rowidCurrentBtn)
-                if rowidCurrentBtn == rowidLastLED:
-                    resultLED = pullLastLEDConfig(controlState.dbName, controlState.LEDConfig.LED_id)
-                    if resultLED == None:
-                        set_LEDs(controlState.vkbDevice, [controlState.defaultLEDConfig])
-                    else:
-                        set_LEDs(controlState.vkbDevice, [resultLED])
-
-
-
-
-
-
-
 
+            ### if the button is on the stack (in any mode) then turn it off
+            if event.is_pressed:
+                resultLED = releaseButtonLEDEvent(controlState.dbName, button_id, controlState.LEDConfig.LED_id,
+                                                  defaultLEDConfig = controlState.defaultLEDConfig)
+                if resultLED is not None:
+                    queueLEDs(controlState.vkbDevice, [resultLED])
@@ -44,77 +44,715 @@ Colors:
 '''
 
 import os
-import pywinusb.hid as hid
+import time
+import atexit
+import logging
+import weakref
+import itertools
+import threading
+
+# pywinusb is Windows only; elsewhere devices come from a transport (see vkb_led_jg_plugin_db_transport)
+try:
+    import pywinusb.hid as hid
+except ImportError:
+    hid = None
+from vkb_led_jg_plugin_db_transport import HIDError, TransportDeviceFilterClass, defaultHIDTransport
 
 import struct
 import bitstruct as bs
 
 import sqlite3
 
+# optional, only decodeLEDReportsArray needs it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 LED_REPORT_ID = 0x59
 LED_REPORT_LEN = 129
 LED_SET_OP_CODE = bytes.fromhex("59a50a")
 LED_CONFIG_COUNT = 4    # plus a dummy
+LED_MAX_CONFIG_COUNT = (LED_REPORT_LEN - 8) // 4    # what fits in a report
+
+
+# LED config encoders turn the fields of an LED config into its 4 byte encoding.
+# LED_ENCODER is the one LEDClass uses; setLEDEncoder swaps it, e.g. to compare the two in a benchmark.
+# LEDClass caches its encoding, so a swap only applies to configs not created yet.
+
+# the original encoder, bit packing through bitstruct
+class LEDBitstructEncoderClass:
+    name = "bitstruct"
+
+    def encode(self, LED_id, colorMode, LEDMode, color1, color2):
+        return struct.pack(">B", LED_id) + bs.byteswap("3",
+                                                       bs.pack("u3" * 8,
+                                                               colorMode,
+                                                               LEDMode,
+                                                               *color2[::-1],
+                                                               *color1[::-1],),)
 
+# The 24 bit config goes out little endian, so the fields land at fixed bit offsets of a plain integer:
+#   r1 0-2, g1 3-5, b1 6-8, r2 9-11, g2 12-14, b2 15-17, LEDMode 18-20, colorMode 21-23.
+# Each field value has a precomputed OR-mask, and the LED id byte is a precomputed 1 byte string.
+class LEDTableEncoderClass:
+    name = "table"
 
+    def __init__(self):
+        self.colorModes = tuple(v << 21 for v in range(8))
+        self.LEDModes = tuple(v << 18 for v in range(8))
+        self.reds1 = tuple(v for v in range(8))
+        self.greens1 = tuple(v << 3 for v in range(8))
+        self.blues1 = tuple(v << 6 for v in range(8))
+        self.reds2 = tuple(v << 9 for v in range(8))
+        self.greens2 = tuple(v << 12 for v in range(8))
+        self.blues2 = tuple(v << 15 for v in range(8))
+        self.ids = tuple(bytes((v,)) for v in range(256))
+
+    def encode(self, LED_id, colorMode, LEDMode, color1, color2):
+        r1, g1, b1 = color1
+        r2, g2, b2 = color2
+        # out of range (or negative) values would index the wrong mask
+        if (colorMode | LEDMode | r1 | g1 | b1 | r2 | g2 | b2) & ~7 or LED_id & ~0xFF:
+            raise ValueError(f"LED config out of range: {(LED_id, colorMode, LEDMode, color1, color2)}")
+        return self.ids[LED_id] + (self.colorModes[colorMode] | self.LEDModes[LEDMode] |
+                                   self.reds1[r1] | self.greens1[g1] | self.blues1[b1] |
+                                   self.reds2[r2] | self.greens2[g2] | self.blues2[b2]).to_bytes(3, "little")
+
+LED_ENCODER = LEDTableEncoderClass()
+
+def setLEDEncoder(encoder):
+    global LED_ENCODER
+    LED_ENCODER = encoder
+
+
+# An LED config is an immutable value: its 4 byte encoding is computed once, and equal configs are
+# interned, so every plugin instance asking for the same config shares one object.
+# It can be used as a dict key; configs compare and hash by their encoding.
 class LEDClass:
-    def __init__(self,
-                 LED_id = 0,
-                 colorMode = 0,
-                 LEDMode = 0,
-                 color1 = [0, 0, 0],
-                 color2 = [0, 0, 0]):
-
-        self.LED_id = int(LED_id)
-        self.colorMode = colorMode
-        self.LEDMode = LEDMode
-        self.color1 = color1
-        self.color2 = color2
+    __slots__ = ("LED_id", "colorMode", "LEDMode", "color1", "color2", "_bytes", "__weakref__")
+
+    _interned = weakref.WeakValueDictionary()
+    _internLock = threading.Lock()
+
+    def __new__(cls,
+                LED_id = 0,
+                colorMode = 0,
+                LEDMode = 0,
+                color1 = (0, 0, 0),
+                color2 = (0, 0, 0)):
+
+        key = (int(LED_id), int(colorMode), int(LEDMode),
+               tuple(int(_) for _ in color1), tuple(int(_) for _ in color2))
+        self = cls._interned.get(key)
+        if self is not None:
+            return self
+        self = object.__new__(cls)
+        for name, value in zip(("LED_id", "colorMode", "LEDMode", "color1", "color2"), key):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "_bytes", self._encode())
+        with cls._internLock:
+            return cls._interned.setdefault(key, self)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("LEDClass is immutable, use replace() for a changed copy")
+
+    def __delattr__(self, name):
+        raise AttributeError("LEDClass is immutable")
+
+    def __reduce__(self):
+        return (LEDClass, (self.LED_id, self.colorMode, self.LEDMode, self.color1, self.color2))
+
+    def __eq__(self, other):
+        if not isinstance(other, LEDClass):
+            return NotImplemented
+        return self._bytes == other._bytes
+
+    def __hash__(self):
+        return hash(self._bytes)
 
     def __repr__(self):
         return (f"<LED_id:{self.LED_id} colorMode:{self.colorMode} LEDMode:{self.LEDMode} "
                 f"color1:{self.color1} color2:{self.color2}>")
 
     def __bytes__(self):
-        return struct.pack(">B", self.LED_id) + bs.byteswap("3",
-                                                            bs.pack("u3" * 8,
-                                                                    self.colorMode,
-                                                                    self.LEDMode,
-                                                                    *self.color2[::-1],
-                                                                    *self.color1[::-1],),)
+        return self._bytes
+
+    def _encode(self):
+        return LED_ENCODER.encode(self.LED_id, self.colorMode, self.LEDMode, self.color1, self.color2)
+
+    # a config with some fields changed
+    def replace(self, **changes):
+        fields = dict(LED_id = self.LED_id, colorMode = self.colorMode, LEDMode = self.LEDMode,
+                      color1 = self.color1, color2 = self.color2)
+        fields.update(changes)
+        return LEDClass(**fields)
+
+    # the inverse of __bytes__, for configs kept in their 4 byte encoding
+    @classmethod
+    def fromBytes(cls, config):
+        bits = int.from_bytes(config[1:4], "little")
+        return cls(config[0],
+                   bits >> 21 & 7,
+                   bits >> 18 & 7,
+                   (bits & 7, bits >> 3 & 7, bits >> 6 & 7),
+                   (bits >> 9 & 7, bits >> 12 & 7, bits >> 15 & 7))
+
+# Builds LED reports in place in one reusable 129 byte buffer:
+#   bytes 0-2 op code, 3-4 checksum, 5-6 nonce, 7 config count, then 4 bytes per config and zero padding.
+# build returns a memoryview of the buffer, valid until the next build.
+class LEDReportBuilderClass:
+
+    DUMMY_CONFIG = bytes(LEDClass(LED_id=99))
+
+    def __init__(self):
+        self.buffer = bytearray(LED_REPORT_LEN)
+        self.buffer[0:3] = LED_SET_OP_CODE
+        self.view = memoryview(self.buffer)
+        self.end = 8            # end of the configs of the last report built
+        # xorshift nonce, seeded once instead of an os.urandom call per report
+        self.nonce = int.from_bytes(os.urandom(2), "little") or 1
+
+    def nextNonce(self):
+        nonce = self.nonce
+        nonce ^= (nonce << 7) & 0xFFFF
+        nonce ^= nonce >> 9
+        nonce ^= (nonce << 8) & 0xFFFF
+        self.nonce = nonce
+        return nonce
+
+    # LED_configs are 4 byte configs, the dummy is added here and counts towards maxConfigs
+    def build(self, LED_configs, maxConfigs = LED_CONFIG_COUNT):
+        num_configs = len(LED_configs) + 1
+        if num_configs > maxConfigs:
+            raise ValueError(f"Can only set a maximum of {maxConfigs} LED configs")
+        buffer = self.buffer
+        pos = 8
+        for config in LED_configs:
+            buffer[pos:pos + 4] = config
+            pos += 4
+        buffer[pos:pos + 4] = self.DUMMY_CONFIG
+        pos += 4
+        if pos < self.end:
+            buffer[pos:self.end] = bytes(self.end - pos)
+        self.end = pos
+        struct.pack_into("<HB", buffer, 5, self.nextNonce(), num_configs)
+        buffer[3:5] = _LED_conf_checksum(num_configs, self.view[5:])
+        return self.view
+
+
+# What per device state (shadow, session, pending updates) is kept under. Plugin instances find the device
+# separately, so it is the device path rather than the HidDevice object, when the device has one.
+def getLEDDeviceKey(dev):
+    return getattr(dev, "device_path", None) or dev
+
+
+# Shadow of what each device's LEDs show, as the last 4 byte config sent per LED id,
+# so configs the LED already shows are not sent again.
+class LEDShadowClass:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}       # device path -> {LED_id: config}
+        self.hits = 0           # configs dropped because the LED already shows them
+        self.misses = 0         # configs that had to be sent
+
+    key = staticmethod(getLEDDeviceKey)
+
+    # the configs (as 4 bytes) that differ from what the device shows
+    def changed(self, dev, LED_configs):
+        configs = [bytes(_) for _ in LED_configs]
+        with self.lock:
+            shown = self.devices.get(self.key(dev), {})
+            result = [config for config in configs if shown.get(config[0]) != config]
+            self.misses += len(result)
+            self.hits += len(configs) - len(result)
+        return result
+
+    def update(self, dev, configs):
+        with self.lock:
+            shown = self.devices.setdefault(self.key(dev), {})
+            for config in configs:
+                shown[config[0]] = config
+
+    # forget what a device (or every device) shows, e.g. after a failed send or a reconnect
+    def invalidate(self, dev = None):
+        with self.lock:
+            if dev is None:
+                self.devices.clear()
+            else:
+                self.devices.pop(self.key(dev), None)
+
+LEDShadow = LEDShadowClass()
+
+
+# A device stays open between LED updates: the session opens it once, parsing only its feature reports,
+# keeps the LED feature report, and is shared by every plugin instance using the device.
+# On a failed send it reopens and tries once more, and the device's shadow is cleared.
+# configCount is how many configs (the dummy included) go in one report, see setLEDConfigCount.
+class LEDDeviceSessionClass:
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.lock = threading.RLock()
+        self.LED_report = None
+        self.builder = LEDReportBuilderClass()
+        self.configCount = LED_CONFIG_COUNT
+
+    def open(self):
+        with self.lock:
+            if self.LED_report is not None and self.dev.is_opened():
+                return
+            if not self.dev.is_opened():
+                self.dev.open(output_only = True, feature_only = True)
+            self.LED_report = self.dev.get_feature_report(LED_REPORT_ID)
+            if self.LED_report is None:
+                raise HIDError(f"Device has no LED feature report 0x{LED_REPORT_ID:02x}")
+
+    def send(self, cmd):
+        with self.lock:
+            for retry in (False, True):
+                try:
+                    self.open()
+                    if self.LED_report.send(cmd):
+                        return
+                    error = HIDError("LED report was not accepted by the device")
+                except HIDError as e:
+                    error = e
+                self.close()
+                # a device that has to be reopened may have been reset (e.g. unplugged and plugged back),
+                # so forget what it showed; the caller then records only what the retry sent
+                LEDShadow.invalidate(self.dev)
+            raise error
+
+    def close(self):
+        with self.lock:
+            self.LED_report = None
+            if self.dev.is_opened():
+                self.dev.close()
+
+
+_LEDSessions = {}
+_LEDSessionsLock = threading.Lock()
+
+def getLEDSession(dev):
+    key = getLEDDeviceKey(dev)
+    session = _LEDSessions.get(key)
+    if session is None:
+        with _LEDSessionsLock:
+            session = _LEDSessions.get(key)
+            if session is None:
+                session = _LEDSessions[key] = LEDDeviceSessionClass(dev)
+    return session
 
+# close every open device, e.g. on exit or before unplugging
+def closeLEDSessions():
+    with _LEDSessionsLock:
+        sessions = list(_LEDSessions.values())
+        _LEDSessions.clear()
+    for session in sessions:
+        session.close()
+
+# registered before the LED coalescer, so it runs after the pending updates are sent at exit
+atexit.register(closeLEDSessions)
+
+# LED_CONFIG_COUNT configs per report is what is known to work; firmware that takes more
+# (up to LED_MAX_CONFIG_COUNT) can be given more, so transactions need fewer reports
+def setLEDConfigCount(dev, count):
+    if not 2 <= count <= LED_MAX_CONFIG_COUNT:
+        raise ValueError(f"LED config count must be 2 to {LED_MAX_CONFIG_COUNT}, the dummy included")
+    session = getLEDSession(dev)
+    with session.lock:
+        session.configCount = count
+
+
+# LED_configs holds LEDClass objects or their 4 byte encoding (as kept on the LED stack);
+# they go out in one report, so there can only be as many as the device's configCount allows
 def set_LEDs(dev, LED_configs):
-    LED_configs.append(LEDClass(LED_id=99))
-    num_configs = len(LED_configs)
-    if num_configs > LED_CONFIG_COUNT:
-        raise ValueError(f"Can only set a maximum of {LED_CONFIG_COUNT} LED configs")
-    LED_configs = b"".join(bytes(_) for _ in LED_configs)
-    LED_configs = os.urandom(2) + struct.pack(">B", num_configs) + LED_configs
-    chksum = _LED_conf_checksum(num_configs, LED_configs)
-    cmd = LED_SET_OP_CODE + chksum + LED_configs
-    cmd = cmd + b"\x00" * (LED_REPORT_LEN - len(cmd))
-    dev.open()
-    LED_report = [_ for _ in dev.find_feature_reports() if _.report_id == LED_REPORT_ID][0]
-    LED_report.send(cmd)
-    dev.close()
+    LED_configs = LEDShadow.changed(dev, LED_configs)
+    if LED_configs:
+        _send_LEDs(dev, LED_configs)
 
+# send 4 byte configs without checking the shadow, and record them in it
+def _send_LEDs(dev, LED_configs):
+    session = getLEDSession(dev)
+    with session.lock:
+        cmd = session.builder.build(LED_configs, session.configCount)
+        try:
+            session.send(cmd)
+        except:
+            LEDShadow.invalidate(dev)
+            raise
+    LEDShadow.update(dev, LED_configs)
 
-def _LED_conf_checksum(num_configs, buf):
-    
-    def conf_checksum_bit(chk, b):
-        chk ^= b
+# send any number of 4 byte configs as full reports, back to back on the one open session;
+# returns the number of reports sent
+def _send_LED_chunks(dev, LED_configs):
+    session = getLEDSession(dev)
+    with session.lock:
+        chunk = session.configCount - 1
+        for i in range(0, len(LED_configs), chunk):
+            _send_LEDs(dev, LED_configs[i:i + chunk])
+    return -(-len(LED_configs) // chunk)
+
+# Set any number of LEDs in one go. When an LED id appears more than once the last config wins.
+# Only configs that differ from what the device shows are sent, unless resync is set,
+# e.g. to restore every LED after the device was reconnected. Returns the number of reports sent.
+def setLEDsTransaction(dev, LED_configs, resync = False):
+    configs = {}
+    for config in LED_configs:
+        config = bytes(config)
+        configs[config[0]] = config
+    configs = list(configs.values())
+    if not resync:
+        configs = LEDShadow.changed(dev, configs)
+    return _send_LED_chunks(dev, configs)
+
+# resend the full LED state of several devices, given as {dev: LED_configs} or (dev, LED_configs) pairs;
+# a device that fails does not stop the others, the first error is raised once all were tried
+def resyncLEDs(updates):
+    if hasattr(updates, "items"):
+        updates = updates.items()
+    error = None
+    reports = 0
+    for dev, LED_configs in updates:
+        try:
+            reports += setLEDsTransaction(dev, LED_configs, resync = True)
+        except Exception as e:
+            if error is None:
+                error = e
+    if error is not None:
+        raise error
+    return reports
+
+
+# The LED report checksum is a CRC-16 with the reflected polynomial 0xA001 and start value 0xFFFF,
+# computed a byte at a time from a 256 entry table instead of bit by bit.
+def _makeLEDChecksumTable():
+    table = []
+    for byte in range(256):
+        chk = byte
         for i in range(8):
-            _ = chk & 1
-            chk >>= 1
-            if _ != 0:
-                chk ^= 0xA001
-        return chk
+            if chk & 1:
+                chk = (chk >> 1) ^ 0xA001
+            else:
+                chk >>= 1
+        table.append(chk)
+    return tuple(table)
+
+LED_CHECKSUM_TABLE = _makeLEDChecksumTable()
+
+# incremental checksum: update() can be called for each piece of the report, copy() keeps a shared prefix
+class LEDChecksumClass:
+    __slots__ = ("value",)
+
+    def __init__(self, value = 0xFFFF):
+        self.value = value
+
+    def update(self, data):
+        table = LED_CHECKSUM_TABLE
+        chk = self.value
+        for b in data:
+            chk = (chk >> 8) ^ table[(chk ^ b) & 0xFF]
+        self.value = chk
+        return self
+
+    def copy(self):
+        return LEDChecksumClass(self.value)
+
+    def digest(self):
+        return struct.pack("<H", self.value)
+
+
+def _LED_conf_checksum(num_configs, buf):
+    return LEDChecksumClass().update(buf[:(num_configs + 1) * 3]).digest()
+
+# the checksums of many full reports at once, e.g. animation frames or a capture to verify
+def checksumLEDReports(reports):
+    table = LED_CHECKSUM_TABLE
+    result = []
+    for report in reports:
+        chk = 0xFFFF
+        for b in report[5:5 + (report[7] + 1) * 3]:
+            chk = (chk >> 8) ^ table[(chk ^ b) & 0xFF]
+        result.append(struct.pack("<H", chk))
+    return result
+
+
+### LED report decoding
+
+# The inverse of LEDReportBuilderClass.build, to check captures of what was actually sent.
+# A report is valid if it is LED_REPORT_LEN bytes, starts with the op code, has a config count
+# that fits the report and a matching checksum; anything else raises ValueError.
+LED_DUMMY_ID = 99
+
+def _checkLEDReport(report):
+    if len(report) != LED_REPORT_LEN:
+        raise ValueError(f"LED report is {len(report)} bytes, expected {LED_REPORT_LEN}")
+    if bytes(report[0:3]) != LED_SET_OP_CODE:
+        raise ValueError(f"LED report op code is {bytes(report[0:3]).hex()}, expected {LED_SET_OP_CODE.hex()}")
+    num_configs = report[7]
+    if not 1 <= num_configs <= LED_MAX_CONFIG_COUNT:
+        raise ValueError(f"LED report config count {num_configs} out of range")
+    return num_configs
+
+# the LED configs of one report, without the trailing dummy config unless includeDummy
+def decodeLEDReport(report, includeDummy = False):
+    num_configs = _checkLEDReport(report)
+    if bytes(report[3:5]) != _LED_conf_checksum(num_configs, report[5:]):
+        raise ValueError("LED report checksum mismatch")
+    configs = [LEDClass.fromBytes(report[pos:pos + 4]) for pos in range(8, 8 + num_configs * 4, 4)]
+    if not includeDummy and configs[-1].LED_id == LED_DUMMY_ID:
+        configs.pop()
+    return configs
+
+# decodeLEDReport for many reports, one list of configs per report;
+# with strict False an invalid report gives None instead of raising.
+# The 4 byte configs repeat a lot in a capture, so each distinct one is decoded once.
+def decodeLEDReports(reports, includeDummy = False, strict = True):
+    reports = [bytes(report) for report in reports]
+    decoded = {}
+    result = []
+    valid = []
+    for index, report in enumerate(reports):
+        try:
+            _checkLEDReport(report)
+        except ValueError as e:
+            if strict:
+                raise ValueError(f"LED report {index}: {e}") from None
+            result.append(None)
+            continue
+        valid.append(index)
+        result.append(report)
+    checksums = checksumLEDReports([result[index] for index in valid])
+    for index, checksum in zip(valid, checksums):
+        report = result[index]
+        if report[3:5] != checksum:
+            if strict:
+                raise ValueError(f"LED report {index}: LED report checksum mismatch")
+            result[index] = None
+            continue
+        configs = []
+        for pos in range(8, 8 + report[7] * 4, 4):
+            config = report[pos:pos + 4]
+            LED = decoded.get(config)
+            if LED is None:
+                LED = decoded[config] = LEDClass.fromBytes(config)
+            configs.append(LED)
+        if not includeDummy and configs[-1].LED_id == LED_DUMMY_ID:
+            configs.pop()
+        result[index] = configs
+    return result
+
+LED_CONFIG_DTYPE = (("report", "u4"), ("nonce", "u2"), ("LED_id", "u1"), ("colorMode", "u1"),
+                    ("LEDMode", "u1"), ("color1", "u1", (3,)), ("color2", "u1", (3,)))
+
+# decodeLEDReports into a numpy structured array with one row per config (dtype LED_CONFIG_DTYPE),
+# "report" being the index of the report the config came from; all the reports are decoded together.
+# With strict False invalid reports are left out, so their index has no rows.
+def decodeLEDReportsArray(reports, includeDummy = False, strict = True):
+    if np is None:
+        raise ImportError("decodeLEDReportsArray needs numpy")
+    data = np.frombuffer(b"".join(bytes(report) for report in reports), dtype=np.uint8)
+    if data.size % LED_REPORT_LEN:
+        raise ValueError(f"LED reports must all be {LED_REPORT_LEN} bytes")
+    data = data.reshape(-1, LED_REPORT_LEN)
+    counts = data[:, 7].astype(np.intp)
+    valid = ((data[:, 0:3] == np.frombuffer(LED_SET_OP_CODE, dtype=np.uint8)).all(axis=1) &
+             (counts >= 1) & (counts <= LED_MAX_CONFIG_COUNT))
+
+    # checksums of all the reports a byte position at a time, each report stops at its own length
+    table = np.array(LED_CHECKSUM_TABLE, dtype=np.uint16)
+    lengths = np.where(valid, (counts + 1) * 3, 0)
+    chk = np.full(len(data), 0xFFFF, dtype=np.uint16)
+    for i in range(int(lengths.max(initial=0))):
+        active = lengths > i
+        chk = np.where(active, (chk >> 8) ^ table[(chk ^ data[:, 5 + i]) & 0xFF], chk)
+    valid &= chk == (data[:, 3].astype(np.uint16) | data[:, 4].astype(np.uint16) << 8)
+
+    if strict and not valid.all():
+        raise ValueError(f"LED report {int(np.argmin(valid))} is not a valid LED report")
+
+    # every config slot of every report, then only the slots in use
+    slots = data[:, 8:8 + LED_MAX_CONFIG_COUNT * 4].reshape(len(data), LED_MAX_CONFIG_COUNT, 4)
+    used = (np.arange(LED_MAX_CONFIG_COUNT) < counts[:, None]) & valid[:, None]
+    if not includeDummy:
+        last = np.arange(LED_MAX_CONFIG_COUNT) == (counts - 1)[:, None]
+        used &= ~(last & (slots[:, :, 0] == LED_DUMMY_ID))
+    reportIndex, slot = np.nonzero(used)
+    configs = slots[reportIndex, slot]
+    bits = (configs[:, 1].astype(np.uint32) | configs[:, 2].astype(np.uint32) << 8 |
+            configs[:, 3].astype(np.uint32) << 16)
+
+    result = np.zeros(len(configs), dtype=list(LED_CONFIG_DTYPE))
+    result["report"] = reportIndex
+    result["nonce"] = data[reportIndex, 5].astype(np.uint16) | data[reportIndex, 6].astype(np.uint16) << 8
+    result["LED_id"] = configs[:, 0]
+    result["colorMode"] = bits >> 21 & 7
+    result["LEDMode"] = bits >> 18 & 7
+    result["color1"] = np.stack([bits & 7, bits >> 3 & 7, bits >> 6 & 7], axis=1)
+    result["color2"] = np.stack([bits >> 9 & 7, bits >> 12 & 7, bits >> 15 & 7], axis=1)
+    return result
+
+
+### LED update coalescing and scheduling
+
+# LED updates from all the plugin instances are collected per device and LED (the latest config of an LED wins)
+# and sent together by a background thread LED_COALESCE_WINDOW seconds after the first one arrives,
+# so LEDs changed by the same mode switch or chord go out in one report instead of one report each.
+# A device is also never sent to more often than every LED_MIN_INTERVAL seconds (see setLEDMinInterval);
+# updates arriving in between replace the pending ones and only the final state goes out.
+# The handlers only queue, they never wait on USB. flushLEDs sends whatever is pending right away.
+LED_COALESCE_WINDOW = 0.005
+LED_MIN_INTERVAL = 0.02
+
+class LEDCoalescerClass(threading.Thread):
+
+    def __init__(self, window = LED_COALESCE_WINDOW, minInterval = LED_MIN_INTERVAL):
+        threading.Thread.__init__(self, name = "LEDCoalescer")
+        self.daemon = True
+        self.window = window
+        self.minInterval = minInterval
+        self.intervals = {}     # device path -> minimum interval, when not minInterval
+        self.pending = {}       # device path -> (device, {LED_id: config}, time first queued)
+        self.lastSent = {}      # device path -> time of the last send
+        self.condition = threading.Condition()
+        self.sendLock = threading.Lock()
+        self.closed = False
+        self.error = None       # the first send error of the thread not yet raised to a caller
+        self.start()
+
+    key = staticmethod(getLEDDeviceKey)
+
+    def setMinInterval(self, dev, interval):
+        with self.condition:
+            self.intervals[self.key(dev)] = interval
+            self.condition.notify()
+
+    def queue(self, dev, LED_configs):
+        key = self.key(dev)
+        with self.condition:
+            if key not in self.pending:
+                self.pending[key] = (dev, {}, time.monotonic())
+            configs = self.pending[key][1]
+            for config in LED_configs:
+                config = bytes(config)
+                configs[config[0]] = config
+            self.condition.notify()
+
+    # when a device's pending updates may go out
+    def _due(self, key):
+        interval = self.intervals.get(key, self.minInterval)
+        return max(self.pending[key][2] + self.window,
+                   self.lastSent.get(key, float("-inf")) + interval)
+
+    # a device that fails does not stop the others, the first error is raised once all were tried
+    def _send(self, pending):
+        error = None
+        with self.sendLock:
+            for key, (dev, configs, queued) in pending.items():
+                # drop what is already shown before splitting into reports
+                configs = LEDShadow.changed(dev, configs.values())
+                if not configs:
+                    continue
+                try:
+                    _send_LED_chunks(dev, configs)
+                except Exception as e:
+                    if error is None:
+                        error = e
+                finally:
+                    with self.condition:
+                        self.lastSent[key] = time.monotonic()
+        if error is not None:
+            raise error
+
+    # send everything queued so far from the calling thread, regardless of the minimum interval
+    def flush(self):
+        with self.condition:
+            pending = self.pending
+            self.pending = {}
+        self._send(pending)
+        self.raiseError()
 
-    chk = 0xFFFF
-    for i in range((num_configs + 1) * 3):
-        chk = conf_checksum_bit(chk, buf[i])
-    return struct.pack("<H", chk)
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        with self.condition:
+            # already logged, and there is no handler left to raise it in
+            self.error = None
+        self.flush()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        return
+                    if not self.pending:
+                        self.condition.wait()
+                        continue
+                    now = time.monotonic()
+                    due = {key: self._due(key) for key in self.pending}
+                    ready = {key: self.pending.pop(key) for key, when in due.items() if when <= now}
+                    if ready:
+                        break
+                    self.condition.wait(min(due.values()) - now)
+            try:
+                self._send(ready)
+            except Exception as error:
+                # nobody is waiting on this thread to see the error: log it and keep it for raiseError
+                logging.getLogger(__name__).error("LED update failed: %s", error)
+                with self.condition:
+                    if self.error is None:
+                        self.error = error
+
+    # raise the send error the background thread kept, if any, once
+    def raiseError(self):
+        with self.condition:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+
+_LEDCoalescer = None
+_LEDCoalescerLock = threading.Lock()
+
+def getLEDCoalescer():
+    global _LEDCoalescer
+    if _LEDCoalescer is None:
+        with _LEDCoalescerLock:
+            if _LEDCoalescer is None:
+                _LEDCoalescer = LEDCoalescerClass()
+    return _LEDCoalescer
+
+# queue LED configs (LEDClass or 4 byte encoding) to be sent with the other pending updates.
+# The sends happen in the background, so a send that failed since the last call raises here
+# (after the configs are queued), in the handler as a failing set_LEDs would.
+def queueLEDs(dev, LED_configs):
+    coalescer = getLEDCoalescer()
+    coalescer.queue(dev, LED_configs)
+    coalescer.raiseError()
+
+# the shortest time between two sends to a device, in seconds
+def setLEDMinInterval(dev, interval):
+    getLEDCoalescer().setMinInterval(dev, interval)
+
+def flushLEDs():
+    if _LEDCoalescer is not None:
+        _LEDCoalescer.flush()
+
+def closeLEDCoalescer():
+    global _LEDCoalescer
+    with _LEDCoalescerLock:
+        coalescer, _LEDCoalescer = _LEDCoalescer, None
+    if coalescer is not None:
+        coalescer.close()
+
+atexit.register(closeLEDCoalescer)
 
 
 class controlStateClass:
@@ -153,8 +791,72 @@ def stringRGBToList(s):
             result = (int(s[0]), int(s[2]), int(s[4]))
     return result
 
-def getUSBDevice(vendor_id, product_id):
-    theDevice = hid.HidDeviceFilter(vendor_id=vendor_id, product_id=product_id).get_devices()
+# Finding devices constructs (and queries) a device object for every HID interface on the machine,
+# so what was found is kept per vendor and product id for USB_DEVICE_CACHE_TTL seconds and shared
+# by every plugin instance; they then also share the device objects (and so their LED sessions).
+# invalidateUSBDevices drops entries early, e.g. from a device change (PnP) notification.
+USB_DEVICE_CACHE_TTL = 30.0
+# pywinusb opens the candidate devices to read their attributes this many at a time,
+# skipping any that take longer than USB_PROBE_TIMEOUT seconds (e.g. a sleeping wireless receiver)
+USB_PROBE_WORKERS = 8
+USB_PROBE_TIMEOUT = 2.0
+
+# transport is a HID transport to find the devices through instead of pywinusb, e.g. a fake one for benchmarks;
+# it is the default transport of the platform when pywinusb cannot be used
+def findUSBDevices(vendor_id, product_id, transport = None):
+    if transport is None and hid is None:
+        transport = defaultHIDTransport()
+        if transport is None:
+            raise HIDError("No HID transport on this platform")
+    if transport is None:
+        return hid.HidDeviceFilter(vendor_id=vendor_id, product_id=product_id).get_devices(
+            max_workers=USB_PROBE_WORKERS, timeout=USB_PROBE_TIMEOUT)
+    return TransportDeviceFilterClass(transport, vendor_id=vendor_id, product_id=product_id).get_devices()
+
+class USBDeviceCacheClass:
+
+    def __init__(self, ttl = USB_DEVICE_CACHE_TTL):
+        self.ttl = ttl
+        # held while finding devices, so instances loading together wait for one search instead of each searching
+        self.lock = threading.Lock()
+        self.devices = {}       # (vendor_id, product_id, transport) -> (time found, devices)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, vendor_id, product_id, transport = None):
+        key = (vendor_id, product_id, transport)
+        with self.lock:
+            entry = self.devices.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            devices = findUSBDevices(vendor_id, product_id, transport)
+            # nothing found is not kept, so a device plugged in later is found on the next call
+            if devices:
+                self.devices[key] = (time.monotonic(), devices)
+            else:
+                self.devices.pop(key, None)
+            return devices
+
+    # None matches any id
+    def invalidate(self, vendor_id = None, product_id = None):
+        with self.lock:
+            for key in [key for key in self.devices
+                        if (vendor_id is None or key[0] == vendor_id) and
+                           (product_id is None or key[1] == product_id)]:
+                del self.devices[key]
+
+USBDeviceCache = USBDeviceCacheClass()
+
+def invalidateUSBDevices(vendor_id = None, product_id = None):
+    USBDeviceCache.invalidate(vendor_id, product_id)
+
+def getUSBDevice(vendor_id, product_id, transport = None, cached = True):
+    if cached:
+        theDevice = USBDeviceCache.get(vendor_id, product_id, transport)
+    else:
+        theDevice = findUSBDevices(vendor_id, product_id, transport)
     if len(theDevice)==0:
         return None
     else:
@@ -163,78 +865,556 @@ def getUSBDevice(vendor_id, product_id):
 
 ### Database functions
 
-def createLEDStack(dbName):
-    the_db = sqlite3.connect(dbName)
-    the_db.execute("DROP TABLE IF EXISTS LEDStack;")
-    the_db.execute('''CREATE TABLE IF NOT EXISTS LEDStack(button_id TEXT,
-                                                          LED_id INT,
-                                                          mode TEXT,
-                                                          colorMode INT,
-                                                          LEDMode INT,
-                                                          color1 TEXT,
-                                                          color2 TEXT);''')
-    the_db.commit()
-    the_db.close()
+# sqlite connections are kept open for the life of the process, one per thread and db file,
+# so the button handlers do not pay for an open/close (and the fsync that goes with it) on every press
+DB_TIMEOUT = 5.0
+DB_PRAGMAS = ("PRAGMA journal_mode=WAL;",
+              "PRAGMA synchronous=NORMAL;",
+              "PRAGMA temp_store=MEMORY;")
 
-def pushButtonLEDEvent(dbName, button_id, LEDConfig, mode):
-    the_db = sqlite3.connect(dbName)
-    the_db.execute("INSERT INTO LEDStack VALUES(?, ?, ?, ?, ?, ?, ?);", 
-                   [button_id,
-                    LEDConfig.LED_id,
+_dbLocal = threading.local()
+_dbConnections = []
+_dbConnectionsLock = threading.Lock()
+_dbGeneration = 0     # bumped by closeDBConnections so every thread drops its closed connections
+
+
+def getDBConnection(dbName):
+    connections = getattr(_dbLocal, "connections", None)
+    if connections is None or _dbLocal.key != (os.getpid(), _dbGeneration):
+        connections = _dbLocal.connections = {}
+        _dbLocal.key = (os.getpid(), _dbGeneration)
+    the_db = connections.get(dbName)
+    if the_db is None:
+        # check_same_thread is off only so closeDBConnections can close them at exit;
+        # each connection is still used by the thread that opened it
+        the_db = sqlite3.connect(dbName, timeout=DB_TIMEOUT, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            the_db.execute(pragma)
+        connections[dbName] = the_db
+        with _dbConnectionsLock:
+            _dbConnections.append(the_db)
+    return the_db
+
+# close every connection opened by this process, e.g. on exit or before deleting the db file
+def closeDBConnections():
+    global _dbGeneration
+    with _dbConnectionsLock:
+        _dbGeneration += 1
+        while _dbConnections:
+            the_db = _dbConnections.pop()
+            try:
+                the_db.close()
+            except sqlite3.Error:
+                pass
+
+atexit.register(closeDBConnections)
+
+
+# sqlite is only a persistence mirror of the in-memory stack, rows carry the same rowid as the stack nodes.
+# The schema is versioned with PRAGMA user_version and upgraded in place by the steps in LED_STACK_MIGRATIONS:
+#   0 - no LEDStack table
+#   1 - original table, no key or indexes, colors as "r,g,b" text
+#   2 - integer primary key, integer color columns, indexes for the per-LED top and the button lookups
+#   3 - the LED config stored as its 4 byte encoding (bytes(LEDClass)) instead of separate columns
+
+def _createLEDStackV2(the_db):
+    the_db.execute('''CREATE TABLE LEDStack(event_id INTEGER PRIMARY KEY,
+                                            button_id TEXT NOT NULL,
+                                            LED_id INTEGER NOT NULL,
+                                            mode TEXT,
+                                            colorMode INTEGER NOT NULL,
+                                            LEDMode INTEGER NOT NULL,
+                                            color1_r INTEGER NOT NULL,
+                                            color1_g INTEGER NOT NULL,
+                                            color1_b INTEGER NOT NULL,
+                                            color2_r INTEGER NOT NULL,
+                                            color2_g INTEGER NOT NULL,
+                                            color2_b INTEGER NOT NULL);''')
+    # event_id is the rowid, so both indexes cover their lookups without touching the table
+    the_db.execute("CREATE INDEX LEDStack_LED ON LEDStack(LED_id, event_id);")
+    the_db.execute("CREATE INDEX LEDStack_button ON LEDStack(button_id, LED_id, mode);")
+
+def _migrateLEDStackV2(the_db):
+    if not the_db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'LEDStack';").fetchone():
+        _createLEDStackV2(the_db)
+        return
+    the_db.execute("ALTER TABLE LEDStack RENAME TO LEDStack_v1;")
+    _createLEDStackV2(the_db)
+    # colors are single digits 0-7, so "r,g,b" always has them at positions 1, 3 and 5
+    the_db.execute('''INSERT INTO LEDStack
+                      SELECT rowid, button_id, LED_id, mode, colorMode, LEDMode,
+                             CAST(substr(color1, 1, 1) AS INTEGER),
+                             CAST(substr(color1, 3, 1) AS INTEGER),
+                             CAST(substr(color1, 5, 1) AS INTEGER),
+                             CAST(substr(color2, 1, 1) AS INTEGER),
+                             CAST(substr(color2, 3, 1) AS INTEGER),
+                             CAST(substr(color2, 5, 1) AS INTEGER)
+                      FROM LEDStack_v1 ORDER BY rowid;''')
+    the_db.execute("DROP TABLE LEDStack_v1;")
+
+def _createLEDStackV3(the_db):
+    the_db.execute('''CREATE TABLE LEDStack(event_id INTEGER PRIMARY KEY,
+                                            button_id TEXT NOT NULL,
+                                            LED_id INTEGER NOT NULL,
+                                            mode TEXT,
+                                            config BLOB NOT NULL);''')
+    the_db.execute("CREATE INDEX LEDStack_LED ON LEDStack(LED_id, event_id);")
+    the_db.execute("CREATE INDEX LEDStack_button ON LEDStack(button_id, LED_id, mode);")
+
+def _migrateLEDStackV3(the_db):
+    the_db.execute("DROP INDEX LEDStack_LED;")
+    the_db.execute("DROP INDEX LEDStack_button;")
+    the_db.execute("ALTER TABLE LEDStack RENAME TO LEDStack_v2;")
+    _createLEDStackV3(the_db)
+    rows = the_db.execute("SELECT * FROM LEDStack_v2 ORDER BY event_id;").fetchall()
+    the_db.executemany("INSERT INTO LEDStack VALUES(?, ?, ?, ?, ?);",
+                       [(row[0], row[1], row[2], row[3],
+                         bytes(LEDClass(row[2], row[4], row[5], list(row[6:9]), list(row[9:12]))))
+                        for row in rows])
+    the_db.execute("DROP TABLE LEDStack_v2;")
+
+# (version, step) pairs, each step upgrades the schema from the previous version
+LED_STACK_MIGRATIONS = ((2, _migrateLEDStackV2),
+                        (3, _migrateLEDStackV3))
+LED_STACK_SCHEMA_VERSION = LED_STACK_MIGRATIONS[-1][0]
+
+def migrateDBLEDStack(dbName):
+    the_db = getDBConnection(dbName)
+    version = the_db.execute("PRAGMA user_version;").fetchone()[0]
+    if version == 0 and the_db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'LEDStack';").fetchone():
+        version = 1     # the original table predates user_version
+    if version > LED_STACK_SCHEMA_VERSION:
+        raise sqlite3.DatabaseError(f"LEDStack schema version {version} is newer than {LED_STACK_SCHEMA_VERSION}")
+    for stepVersion, step in LED_STACK_MIGRATIONS:
+        if stepVersion <= version:
+            continue
+        _runDBLEDStackStep(the_db, step, stepVersion)
+        version = stepVersion
+    return version
+
+# Each step runs in its own explicit transaction, so its DDL, the data copy and user_version are
+# committed or rolled back together (sqlite3's default mode commits DDL statements on their own).
+def _runDBLEDStackStep(the_db, step, stepVersion):
+    if the_db.in_transaction:
+        the_db.commit()
+    isolation_level = the_db.isolation_level
+    the_db.isolation_level = None
+    try:
+        the_db.execute("BEGIN IMMEDIATE;")
+        try:
+            step(the_db)
+            the_db.execute(f"PRAGMA user_version = {stepVersion};")
+        except:
+            the_db.execute("ROLLBACK;")
+            raise
+        the_db.execute("COMMIT;")
+    finally:
+        the_db.isolation_level = isolation_level
+
+def createDBLEDStack(dbName, clear = True):
+    migrateDBLEDStack(dbName)
+    if clear:
+        the_db = getDBConnection(dbName)
+        the_db.execute("DELETE FROM LEDStack;")
+        the_db.commit()
+
+def insertDBLEDEvent(dbName, rowid, button_id, config, mode):
+    the_db = getDBConnection(dbName)
+    the_db.execute("INSERT INTO LEDStack VALUES(?, ?, ?, ?, ?);",
+                   [rowid,
+                    button_id,
+                    config[0],
                     mode,
-                    LEDConfig.colorMode,
-                    LEDConfig.LEDMode,
-                    ",".join(map(str, LEDConfig.color1)),
-                    ",".join(map(str, LEDConfig.color2))])
+                    config])
+    the_db.commit()
+
+def deleteDBLEDEvent(dbName, rowid):
+    the_db = getDBConnection(dbName)
+    the_db.execute("DELETE FROM LEDStack WHERE event_id = ?;", (rowid,))
     the_db.commit()
-    the_db.close()
+
+# write a batch of inserts (rowid, button_id, LED_id, mode, config) and deleted rowids in one transaction
+def writeDBLEDEvents(dbName, inserts, deletes):
+    the_db = getDBConnection(dbName)
+    with the_db:
+        if inserts:
+            the_db.executemany("INSERT INTO LEDStack VALUES(?, ?, ?, ?, ?);", inserts)
+        if deletes:
+            the_db.executemany("DELETE FROM LEDStack WHERE event_id = ?;", [(rowid,) for rowid in deletes])
+
+# all the persisted events, oldest first, as (rowid, button_id, mode, 4 byte LED config)
+def loadDBLEDEvents(dbName):
+    the_db = getDBConnection(dbName)
+    for row in the_db.execute("SELECT event_id, button_id, mode, config FROM LEDStack ORDER BY event_id;"):
+        yield row[0], row[1], row[2], bytes(row[3])
+
+
+# Write-behind: stack mutations are queued and a background thread writes them to sqlite in one
+# transaction per batch, after DB_WRITE_INTERVAL seconds or as soon as DB_WRITE_QUEUE_DEPTH are pending.
+# An event pushed and removed before its batch is written never reaches the disk.
+DB_WRITE_INTERVAL = 0.5
+DB_WRITE_QUEUE_DEPTH = 64
+
+class LEDStackWriterClass(threading.Thread):
+
+    def __init__(self, dbName, interval = DB_WRITE_INTERVAL, queueDepth = DB_WRITE_QUEUE_DEPTH):
+        threading.Thread.__init__(self, name = "LEDStackWriter")
+        self.daemon = True
+        self.dbName = dbName
+        self.interval = interval
+        self.queueDepth = queueDepth
+        self.pending = {}       # rowid -> insert row, or None for a delete, in mutation order
+        self.condition = threading.Condition()
+        self.writeLock = threading.Lock()
+        self.closed = False
+        self.start()
+
+    def insert(self, rowid, button_id, config, mode):
+        self._queue(rowid, (rowid, button_id, config[0], mode, config))
+
+    def delete(self, rowid):
+        with self.condition:
+            if self.pending.get(rowid) is not None:
+                del self.pending[rowid]         # never written, nothing to delete
+                return
+        self._queue(rowid, None)
+
+    def _queue(self, rowid, row):
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("LED stack writer is closed")
+            self.pending[rowid] = row
+            if len(self.pending) == 1 or len(self.pending) >= self.queueDepth:
+                self.condition.notify()
+
+    # write everything queued so far, from the calling thread
+    def flush(self):
+        with self.writeLock:
+            with self.condition:
+                pending = self.pending
+                self.pending = {}
+            if pending:
+                writeDBLEDEvents(self.dbName,
+                                 [row for row in pending.values() if row is not None],
+                                 [rowid for rowid, row in pending.items() if row is None])
+
+    # flush and stop the thread
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        self.flush()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                # let a burst of presses gather into one batch
+                if not self.closed and len(self.pending) < self.queueDepth:
+                    self.condition.wait(self.interval)
+                closed = self.closed
+            try:
+                self.flush()
+            except sqlite3.Error:
+                pass    # the in-memory stack is authoritative, a failed batch only loses the mirror
+            if closed:
+                return
+
+
+### LED event stack
+
+# The stack is a set of per-LED LIFO stacks where any event can be removed, not just the top.
+# Each LED keeps a doubly linked list of nodes with a pointer to its top, and the nodes are indexed
+# by rowid and by (button_id, LED_id, mode) so push, remove and peek never scan.
+# Configs are kept in their 4 byte encoding, so what comes off the stack is ready to send.
+
+class LEDStackNodeClass:
+    __slots__ = ("rowid", "button_id", "LED_id", "mode", "config", "prev", "next")
+
+    def __init__(self, rowid, button_id, LED_id, mode, config):
+        self.rowid = rowid
+        self.button_id = button_id
+        self.LED_id = LED_id
+        self.mode = mode
+        self.config = config
+        self.prev = None    # towards the bottom of the LED stack
+        self.next = None    # towards the top of the LED stack
+
+
+class LEDStackClass:
+
+    def __init__(self, dbName = None, persist = False, restore = False, writeBehind = False,
+                 writeInterval = DB_WRITE_INTERVAL, writeQueueDepth = DB_WRITE_QUEUE_DEPTH, session = None):
+        self.dbName = dbName
+        self.session = session
+        self.persist = persist and dbName is not None
+        self.writer = None
+        self.lock = threading.RLock()
+        self.lastRowid = 0
+        self.tops = {}          # LED_id -> top node
+        self.rows = {}          # rowid -> node
+        self.events = {}        # (button_id, LED_id, mode) -> {rowid: node}, oldest first
+        self.buttons = {}       # (button_id, LED_id) -> {rowid: node}, oldest first
+        if self.persist:
+            createDBLEDStack(dbName, clear = not restore)
+            if restore:
+                for rowid, button_id, mode, config in loadDBLEDEvents(dbName):
+                    self._link(rowid, button_id, config, mode)
+            if writeBehind:
+                self.writer = LEDStackWriterClass(dbName, writeInterval, writeQueueDepth)
+
+    def __len__(self):
+        return len(self.rows)
+
+    # LEDConfig is an LEDClass or its 4 byte encoding
+    def push(self, button_id, LEDConfig, mode):
+        config = bytes(LEDConfig)
+        with self.lock:
+            node = self._link(self.lastRowid + 1, button_id, config, mode)
+            if self.writer is not None:
+                self.writer.insert(node.rowid, button_id, config, mode)
+            elif self.persist:
+                insertDBLEDEvent(self.dbName, node.rowid, button_id, config, mode)
+            return node.rowid
+
+    def _link(self, rowid, button_id, config, mode):
+        node = LEDStackNodeClass(rowid, button_id, config[0], mode, config)
+        top = self.tops.get(node.LED_id)
+        if top is not None:
+            top.next = node
+            node.prev = top
+        self.tops[node.LED_id] = node
+        self.rows[rowid] = node
+        self.events.setdefault((button_id, node.LED_id, mode), {})[rowid] = node
+        self.buttons.setdefault((button_id, node.LED_id), {})[rowid] = node
+        self.lastRowid = max(self.lastRowid, rowid)
+        return node
+
+    def remove(self, rowid):
+        with self.lock:
+            node = self.rows.pop(rowid, None)
+            if node is None:
+                return None
+            if node.next is not None:
+                node.next.prev = node.prev
+            elif node.prev is not None:
+                self.tops[node.LED_id] = node.prev
+            else:
+                del self.tops[node.LED_id]
+            if node.prev is not None:
+                node.prev.next = node.next
+            node.prev = node.next = None
+            self._unindex(self.events, (node.button_id, node.LED_id, node.mode), rowid)
+            self._unindex(self.buttons, (node.button_id, node.LED_id), rowid)
+            if self.writer is not None:
+                self.writer.delete(rowid)
+            elif self.persist:
+                deleteDBLEDEvent(self.dbName, rowid)
+            return node
+
+    # write out anything still queued for the db and stop the write-behind thread
+    def close(self):
+        with self.lock:
+            writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+
+    @staticmethod
+    def _unindex(index, key, rowid):
+        nodes = index[key]
+        del nodes[rowid]
+        if not nodes:
+            del index[key]
+
+    def peek(self, LED_id):
+        return self.tops.get(LED_id)
+
+    # the oldest event of a button on an LED, in a given mode or in any mode
+    def find(self, button_id, LED_id, mode = None):
+        if mode is None:
+            nodes = self.buttons.get((button_id, LED_id))
+        else:
+            nodes = self.events.get((button_id, LED_id, mode))
+        if not nodes:
+            return None
+        return next(iter(nodes.values()))
+
+    # remove a button event and return the 4 byte config the LED should show now,
+    # or None when the event was not on top and the LED does not change
+    def release(self, node, defaultLEDConfig = None):
+        with self.lock:
+            onTop = self.tops.get(node.LED_id) is node
+            self.remove(node.rowid)
+            if not onTop:
+                return None
+            top = self.tops.get(node.LED_id)
+            if top is None:
+                return None if defaultLEDConfig is None else bytes(defaultLEDConfig)
+            return top.config
+
+    # push or remove the button event in one step and return the 4 byte config to send, if any
+    def toggle(self, button_id, LEDConfig, mode, pressed, whilePressed, defaultLEDConfig = None):
+        config = bytes(LEDConfig)
+        with self.lock:
+            node = self.find(button_id, config[0], mode)
+            if node is None:
+                if not pressed:
+                    return None
+                self.push(button_id, config, mode)
+                return config
+            if ((pressed and not whilePressed) or        # normal button turn off
+                (not pressed and whilePressed)):         # while pressed turn off
+                return self.release(node, defaultLEDConfig)
+            return None
+
+
+# one stack per db name, shared by all the plugin instances in the process
+_LEDStacks = {}
+_LEDStacksLock = threading.Lock()
+
+# the stack is created once per session; every plugin instance of the session attaches to it
+_LEDStackSessionCount = itertools.count(1)
+
+def newLEDStackSession():
+    return f"{os.getpid()}-{time.time():.6f}-{next(_LEDStackSessionCount)}"
+
+# A session is one profile activation. Joystick Gremlin runs the plugin module again for every instance
+# on each activation but keeps this library loaded, and gives the plugin no stop notification.
+# Each instance loads once per activation, so the plugin passes its instance (anything that identifies it,
+# e.g. its button and settings) to getLEDStackSession and an instance loading a second time starts a new session.
+# Without an instance, or when none of the new activation's instances were in the last one, the fallback is a
+# heuristic: a new session starts when no instance was loaded in the last LED_STACK_SESSION_GAP seconds,
+# as the instances of an activation load back to back. A stop and start quicker than that is not told apart.
+# startLEDStackSession starts one right away, e.g. from a profile start hook.
+LED_STACK_SESSION_GAP = 2.0
+
+_LEDStackSession = None
+_LEDStackSessionInstances = set()       # the instances loaded in the current session
+_LEDStackSessionSeen = float("-inf")    # time of the last getLEDStackSession
+_LEDStackSessionLock = threading.Lock()
+
+# with _LEDStackSessionLock held
+def _startLEDStackSession():
+    global _LEDStackSession, _LEDStackSessionSeen
+    _LEDStackSession = newLEDStackSession()
+    _LEDStackSessionInstances.clear()
+    _LEDStackSessionSeen = time.monotonic()
+    # a new activation sends every LED again instead of trusting what the last one showed
+    LEDShadow.invalidate()
+    return _LEDStackSession
+
+def startLEDStackSession():
+    with _LEDStackSessionLock:
+        return _startLEDStackSession()
+
+# the session of the plugin instance being loaded now
+def getLEDStackSession(instance = None):
+    global _LEDStackSessionSeen
+    with _LEDStackSessionLock:
+        now = time.monotonic()
+        if (_LEDStackSession is None or instance in _LEDStackSessionInstances or
+                now - _LEDStackSessionSeen > LED_STACK_SESSION_GAP):
+            _startLEDStackSession()
+        if instance is not None:
+            _LEDStackSessionInstances.add(instance)
+        _LEDStackSessionSeen = now
+        return _LEDStackSession
+
+def getLEDStack(dbName):
+    stack = _LEDStacks.get(dbName)
+    if stack is None:
+        with _LEDStacksLock:
+            stack = _LEDStacks.get(dbName)
+            if stack is None:
+                stack = _LEDStacks[dbName] = LEDStackClass(dbName, session = _LEDStackSession)
+    return stack
+
+# Start an empty stack for the session, or attach to the stack the session already started.
+# Only the first call of a session creates the stack (and touches the db), the options of later calls
+# are ignored; a call with a different session replaces the stack. session defaults to getLEDStackSession().
+# With persist the events are also mirrored to the LEDStack table in dbName,
+# with writeBehind those writes are batched by a background thread instead of made in the handler,
+# and with restore the stack starts from the events already in that table instead of empty.
+def createLEDStack(dbName, persist = False, restore = False, writeBehind = False,
+                   writeInterval = DB_WRITE_INTERVAL, writeQueueDepth = DB_WRITE_QUEUE_DEPTH,
+                   session = None):
+    if session is None:
+        session = getLEDStackSession()
+    stack = _LEDStacks.get(dbName)
+    if stack is not None and stack.session == session:
+        return stack
+    with _LEDStacksLock:
+        stack = _LEDStacks.get(dbName)
+        if stack is not None and stack.session == session:
+            return stack
+        if stack is not None:
+            stack.close()
+        stack = _LEDStacks[dbName] = LEDStackClass(dbName, persist, restore, writeBehind,
+                                                   writeInterval, writeQueueDepth, session)
+        return stack
+
+# flush pending db writes of every stack, e.g. on exit
+def closeLEDStacks():
+    with _LEDStacksLock:
+        for stack in _LEDStacks.values():
+            stack.close()
+
+# registered after closeDBConnections, so it runs first at exit
+atexit.register(closeLEDStacks)
+
+def pushButtonLEDEvent(dbName, button_id, LEDConfig, mode):
+    return getLEDStack(dbName).push(button_id, LEDConfig, mode)
 
 
 # pull the LEDConfig for the last LED id
 def pullLastLEDConfig(dbName, LED_id):
-    the_db = sqlite3.connect(dbName)
-    cursor = the_db.cursor()
-    cursor.execute(f"SELECT * FROM LEDStack WHERE rowid = (SELECT MAX(rowid) FROM LEDStack WHERE LED_id = {LED_id});")    
-    result = cursor.fetchone()
-    the_db.close()
-    if result == None:
+    node = getLEDStack(dbName).peek(LED_id)
+    if node == None:
         return None
     else:
-        LEDConfig = LEDClass(result[1], result[3], result[4], list(map(int, result[5].split(","))), list(map(int, result[6].split(","))))
-        return LEDConfig
+        return LEDClass.fromBytes(node.config)
+
+# pull the 4 byte encoded config for the last LED id, ready for set_LEDs
+def pullLastLEDBytes(dbName, LED_id):
+    node = getLEDStack(dbName).peek(LED_id)
+    if node == None:
+        return None
+    else:
+        return node.config
 
 # return the row id of a given btn, LED, & optional mode
 def getRowidButtonLEDModeEvent(dbName, button_id, LED_id, mode=None):
-    the_db = sqlite3.connect(dbName)
-    cursor = the_db.cursor()
-    if mode == None:
-        cursor.execute(f"SELECT rowid FROM LEDStack WHERE button_id='{button_id}' AND LED_id={LED_id};")        
-    else:
-        cursor.execute(f"SELECT rowid FROM LEDStack WHERE button_id='{button_id}' AND LED_id={LED_id} AND mode='{mode}';")
-    result = cursor.fetchone()
-    the_db.close()
-    if result == None:
+    node = getLEDStack(dbName).find(button_id, LED_id, mode)
+    if node == None:
         return 0
     else:
-        return result[0]
+        return node.rowid
 
 # return the last row if for given LED
 def getLastRowidLEDEvent(dbName, LED_id):
-    the_db = sqlite3.connect(dbName)
-    cursor = the_db.cursor()
-    cursor.execute(f"SELECT rowid FROM LEDStack WHERE rowid = (SELECT MAX(rowid) FROM LEDStack WHERE LED_id = {LED_id});")        
-    result = cursor.fetchone()
-    the_db.close()
-    if result == None:
+    node = getLEDStack(dbName).peek(LED_id)
+    if node == None:
         return 0
     else:
-        return result[0]
+        return node.rowid
 
 # delete a given row
 def deleteRowid(dbName, rowid):
-    the_db = sqlite3.connect(dbName)
-    cursor = the_db.cursor()
-    cursor.execute(f"DELETE FROM LEDStack WHERE rowid = {rowid};")
-    the_db.commit()
-    the_db.close()
+    getLEDStack(dbName).remove(rowid)
+
+# a button press or release: turns the button on or off and returns the 4 byte config to send,
+# the default LEDConfig encoding when the LED stack is now empty, or None when the LED does not change
+def toggleButtonLEDEvent(dbName, button_id, LEDConfig, mode, pressed, whilePressed, defaultLEDConfig = None):
+    return getLEDStack(dbName).toggle(button_id, LEDConfig, mode, pressed, whilePressed, defaultLEDConfig)
 
+# turn a button off in the given mode, or in any mode; returns the config to send like toggleButtonLEDEvent
+def releaseButtonLEDEvent(dbName, button_id, LED_id, mode = None, defaultLEDConfig = None):
+    stack = getLEDStack(dbName)
+    with stack.lock:
+        node = stack.find(button_id, LED_id, mode)
+        if node is None:
+            return None
+        return stack.release(node, defaultLEDConfig)
@@ -0,0 +1,359 @@
+'''
+
+vkb_led_jg_plugin_db_transport.py
+
+Wesley Covalt
+
+HID transports for the Joystick Gremlin VKB LED plugin library, so the LED pipeline can run (and be benchmarked)
+without pywinusb and Windows.
+
+A transport covers the few HID operations the library needs:
+
+    enumerate(vendor_id, product_id)    -> HIDDeviceInfoClass for each matching device
+    open(path)                          -> a handle
+    send_feature(handle, data)          -> True if the report was accepted
+    get_feature(handle, report_id, length)
+    read_input(handle, length, timeout) -> the next input report, None on timeout
+    close(handle)
+
+TransportDeviceClass wraps a transport device in the part of the pywinusb HidDevice interface the library uses
+(open, is_opened, close, get_feature_report and the report's send), so set_LEDs and the LED sessions take either.
+TransportDeviceFilterClass is the HidDeviceFilter counterpart.
+
+Two transports are here:
+    FakeHIDTransportClass    in memory devices that record every report with a timestamp
+    HidrawTransportClass     Linux /dev/hidraw devices
+
+'''
+
+import os
+import sys
+import time
+import select
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:     # not on Windows
+    fcntl = None
+
+# the same error type as pywinusb where it is available, so callers catch one exception either way
+try:
+    from pywinusb.hid import HIDError
+except ImportError:
+    class HIDError(Exception):
+        pass
+
+
+# what enumerate returns for a device
+class HIDDeviceInfoClass:
+
+    def __init__(self, path, vendor_id, product_id, vendor_name = "", product_name = "", serial_number = ""):
+        self.path = path
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.vendor_name = vendor_name
+        self.product_name = product_name
+        self.serial_number = serial_number
+
+    def __repr__(self):
+        return f"<HID device {self.path} {self.vendor_id:04x}:{self.product_id:04x} {self.product_name}>"
+
+
+# the transport interface; a transport missing any of these cannot be created
+class HIDTransportClass(ABC):
+    name = None
+
+    @abstractmethod
+    def enumerate(self, vendor_id = None, product_id = None):
+        pass
+
+    @abstractmethod
+    def open(self, path):
+        pass
+
+    @abstractmethod
+    def send_feature(self, handle, data):
+        pass
+
+    @abstractmethod
+    def get_feature(self, handle, report_id, length):
+        pass
+
+    @abstractmethod
+    def read_input(self, handle, length, timeout = None):
+        pass
+
+    @abstractmethod
+    def close(self, handle):
+        pass
+
+
+### pywinusb style wrappers
+
+# a feature report of a transport device, like pywinusb's HidReport as far as the library uses it
+class TransportReportClass:
+
+    def __init__(self, device, report_id):
+        self.device = device
+        self.report_id = report_id
+
+    # data starts with the report id
+    def send(self, data):
+        return self.device.transport.send_feature(self.device.handle(), data)
+
+    # the raw report as the device returns it, report id first
+    def get(self, length):
+        return self.device.transport.get_feature(self.device.handle(), self.report_id, length)
+
+
+class TransportDeviceClass:
+
+    def __init__(self, transport, info):
+        self.transport = transport
+        self.info = info
+        self.device_path = info.path
+        self.vendor_id = info.vendor_id
+        self.product_id = info.product_id
+        self.vendor_name = info.vendor_name
+        self.product_name = info.product_name
+        self.serial_number = info.serial_number
+        self.lock = threading.Lock()
+        self._handle = None
+
+    def __repr__(self):
+        return f"<TransportDeviceClass {self.transport.name} {self.info}>"
+
+    # the pywinusb arguments are accepted for compatibility; a transport has no report parsing to skip
+    def open(self, output_only = False, shared = True, feature_only = False, raw_only = False):
+        with self.lock:
+            if self._handle is not None:
+                raise HIDError("Device already opened")
+            self._handle = self.transport.open(self.device_path)
+
+    def is_opened(self):
+        return self._handle is not None
+
+    def close(self):
+        with self.lock:
+            handle = self._handle
+            self._handle = None
+            if handle is not None:
+                self.transport.close(handle)
+
+    def handle(self):
+        handle = self._handle
+        if handle is None:
+            raise HIDError("Device not opened")
+        return handle
+
+    # transports do not parse report descriptors, so any report id is taken to exist
+    def get_feature_report(self, report_id):
+        return TransportReportClass(self, report_id)
+
+    def read_input(self, length, timeout = None):
+        return self.transport.read_input(self.handle(), length, timeout)
+
+
+# like pywinusb's HidDeviceFilter: keyword arguments are device attributes to match
+class TransportDeviceFilterClass:
+
+    def __init__(self, transport, **filters):
+        self.transport = transport
+        self.filters = filters
+
+    def get_devices(self):
+        infos = self.transport.enumerate(self.filters.get("vendor_id"), self.filters.get("product_id"))
+        return [TransportDeviceClass(self.transport, info) for info in infos
+                if all(getattr(info, name, None) == value for name, value in self.filters.items())]
+
+
+### In memory transport
+
+# one fake device: the last report sent per feature report id, queued input reports and a log of every report
+# as (timestamp, direction, bytes), direction being "feature out", "feature in" or "input"
+class FakeHIDDeviceClass:
+
+    def __init__(self, info, latency = 0.0):
+        self.info = info
+        self.latency = latency      # seconds each send takes, to stand in for USB
+        self.features = {}
+        self.inputs = deque()
+        self.reports = []
+        self.opens = 0
+        self.fail = 0               # number of upcoming sends to reject
+        self.opened = False
+        self.present = True
+
+
+# Devices only change when told to and nothing runs in the background, so runs are repeatable.
+# clock gives the report timestamps, time.perf_counter by default.
+class FakeHIDTransportClass(HIDTransportClass):
+    name = "fake"
+
+    def __init__(self, clock = None):
+        self.clock = clock or time.perf_counter
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def addDevice(self, path, vendor_id, product_id, vendor_name = "", product_name = "", serial_number = "",
+                  latency = 0.0):
+        info = HIDDeviceInfoClass(path, vendor_id, product_id, vendor_name, product_name, serial_number)
+        with self.lock:
+            device = self.devices[path] = FakeHIDDeviceClass(info, latency)
+        return device
+
+    # unplug: the device disappears from enumerate and its open handles fail
+    def removeDevice(self, path):
+        with self.lock:
+            device = self.devices.pop(path, None)
+        if device is not None:
+            device.present = False
+
+    def pushInput(self, path, data):
+        self.devices[path].inputs.append(bytes(data))
+
+    def enumerate(self, vendor_id = None, product_id = None):
+        with self.lock:
+            devices = list(self.devices.values())
+        return [device.info for device in devices
+                if (vendor_id is None or device.info.vendor_id == vendor_id) and
+                   (product_id is None or device.info.product_id == product_id)]
+
+    def open(self, path):
+        device = self.devices.get(path)
+        if device is None:
+            raise HIDError(f"No such device: {path}")
+        device.opens += 1
+        device.opened = True
+        return device
+
+    def _check(self, device):
+        if not device.present or not device.opened:
+            raise HIDError(f"Device not available: {device.info.path}")
+
+    def send_feature(self, device, data):
+        self._check(device)
+        if device.latency:
+            time.sleep(device.latency)
+        if device.fail:
+            device.fail -= 1
+            return False
+        data = bytes(data)
+        device.features[data[0]] = data
+        device.reports.append((self.clock(), "feature out", data))
+        return True
+
+    def get_feature(self, device, report_id, length):
+        self._check(device)
+        data = device.features.get(report_id, bytes((report_id,)))[:length]
+        data += bytes(length - len(data))
+        device.reports.append((self.clock(), "feature in", data))
+        return data
+
+    # there is nothing to wait for, so an empty queue returns None straight away
+    def read_input(self, device, length, timeout = None):
+        self._check(device)
+        if not device.inputs:
+            return None
+        data = device.inputs.popleft()[:length]
+        device.reports.append((self.clock(), "input", data))
+        return data
+
+    def close(self, device):
+        device.opened = False
+
+
+### Linux hidraw transport
+
+# ioctl numbers from linux/hidraw.h
+def _IOC(direction, kind, nr, size):
+    return direction << 30 | size << 16 | ord(kind) << 8 | nr
+
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+def HIDIOCSFEATURE(length):
+    return _IOC(_IOC_WRITE | _IOC_READ, "H", 0x06, length)
+
+def HIDIOCGFEATURE(length):
+    return _IOC(_IOC_WRITE | _IOC_READ, "H", 0x07, length)
+
+
+# Devices are found through sysfs; the user needs read/write access to the /dev/hidraw nodes (a udev rule).
+# A handle is the file descriptor.
+class HidrawTransportClass(HIDTransportClass):
+    name = "hidraw"
+
+    SYSFS_DIR = "/sys/class/hidraw"
+
+    def enumerate(self, vendor_id = None, product_id = None):
+        result = []
+        try:
+            nodes = sorted(os.listdir(self.SYSFS_DIR))
+        except OSError:
+            return result
+        for node in nodes:
+            try:
+                with open(os.path.join(self.SYSFS_DIR, node, "device", "uevent")) as f:
+                    uevent = dict(line.rstrip("\n").split("=", 1) for line in f if "=" in line)
+                # HID_ID=<bus>:<vendor>:<product>, all hex
+                bus, vendor, product = (int(_, 16) for _ in uevent["HID_ID"].split(":"))
+            except (OSError, KeyError, ValueError):
+                continue
+            if (vendor_id is not None and vendor != vendor_id) or (product_id is not None and product != product_id):
+                continue
+            # the kernel only has the combined manufacturer and product string
+            result.append(HIDDeviceInfoClass("/dev/" + node, vendor, product,
+                                             product_name = uevent.get("HID_NAME", ""),
+                                             serial_number = uevent.get("HID_UNIQ", "")))
+        return result
+
+    def open(self, path):
+        if fcntl is None:
+            raise HIDError("hidraw needs Linux")
+        try:
+            return os.open(path, os.O_RDWR)
+        except OSError as e:
+            raise HIDError(f"Cannot open {path}: {e}") from e
+
+    def send_feature(self, fd, data):
+        data = bytearray(data)
+        try:
+            fcntl.ioctl(fd, HIDIOCSFEATURE(len(data)), data, True)
+            return True
+        except OSError as e:
+            raise HIDError(f"Feature report not sent: {e}") from e
+
+    def get_feature(self, fd, report_id, length):
+        buffer = bytearray(length)
+        buffer[0] = report_id
+        try:
+            count = fcntl.ioctl(fd, HIDIOCGFEATURE(length), buffer, True)
+        except OSError as e:
+            raise HIDError(f"Feature report not read: {e}") from e
+        return bytes(buffer[:count])
+
+    def read_input(self, fd, length, timeout = None):
+        try:
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                return None
+            return os.read(fd, length)
+        except OSError as e:
+            raise HIDError(f"Input report not read: {e}") from e
+
+    def close(self, fd):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+# the transport to use when pywinusb is not available
+def defaultHIDTransport():
+    if sys.platform.startswith("linux"):
+        return HidrawTransportClass()
+    return None